@@ -1,16 +1,29 @@
+import errno
 import shutil
 import logging
 import os
 import sqlite3
 
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from app.tools import media, exceptions, helpers
+from itertools import islice
+from app.tools import accounts, admission, dedup, media, exceptions, helpers, metrics, quota, scheduler, storage
 from app.config import config
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from time import sleep
+from queue import Queue, Empty
+from threading import current_thread, Event, RLock, Thread
+from time import monotonic, sleep
 
+DB_MIGRATIONS_PATH = 'db/migrations'
+MAX_PAGE_SIZE = 100  # Max pageSize accepted by mediaItems.list
+SELECTION_PAGE_SIZE = 1000  # Rows read from the DB at once by LocalStorage selections
+QUEUE_SMALL = 0  # download_queue priorities
+QUEUE_LARGE = 1
+PREVIEW_EXPECTED_SIZE = 2 ** 20  # Bytes of a preview assumed by admission control
 SCOPES = [
     'https://www.googleapis.com/auth/photoslibrary.readonly',
     # 'https://www.googleapis.com/auth/photoslibrary',
@@ -20,28 +33,76 @@ SCOPES = [
 
 
 class Authentication:
-    def __init__(self):
+    """Credential manager shared by all workers.
+
+    The token is refreshed under a lock, ahead of expiry by a background thread and on demand
+    after a 401, token.json is replaced atomically.
+    """
+
+    def __init__(self, profile=None, api_quota=None):
+        """
+        :param profile: accounts.Profile of the account, the default profile of config if it is not set
+        :param api_quota: quota.ApiQuota shared with other accounts of the same client id
+        """
         self.creds = None
+        self.__token_file_path = (profile or accounts.default_profile(config)).access_token_file_path
+        self.quota = api_quota or quota.ApiQuota(config.API_DAILY_QUOTA)
+        self.__lock = RLock()
+        self.__refresher = None
         self.__logger = logging.getLogger(self.__class__.__name__)
 
     @property
     def access_token(self) -> str:
-        if not self.creds:
-            if os.path.exists(config.ACCESS_TOKEN_FILE_PATH):
-                self.creds = Credentials.from_authorized_user_file(config.ACCESS_TOKEN_FILE_PATH, SCOPES)
-            else:
-                self.__get_auth()
-        if self.creds.expired:
-            self.creds.refresh(Request())
-            self.__write_access_token_to_file()
-            self.__logger.info('Access token refreshed.')
-        if not self.creds.valid:
-            raise exceptions.AuthUnsuccessful()
-        return self.creds.token
+        with self.__lock:
+            if not self.creds:
+                if os.path.exists(self.__token_file_path):
+                    self.creds = Credentials.from_authorized_user_file(self.__token_file_path, SCOPES)
+                else:
+                    self.__get_auth()
+                self.__start_refresher()
+            if self.creds.expired:
+                self.__refresh()
+            if not self.creds.valid:
+                raise exceptions.AuthUnsuccessful()
+            return self.creds.token
+
+    def refresh(self, stale_token=None):
+        """Refreshes the token, does nothing if another thread has already replaced stale_token."""
+        with self.__lock:
+            if stale_token and self.creds and self.creds.token != stale_token:
+                return
+            self.__refresh()
+
+    def __refresh(self):
+        self.creds.refresh(Request(helpers.http_session()))
+        self.__write_access_token_to_file()
+        self.__logger.info('Access token refreshed.')
+
+    def __start_refresher(self):
+        if self.__refresher or not self.creds.expiry:
+            return
+        self.__refresher = Thread(target=self.__refresh_ahead, name='token-refresher', daemon=True)
+        self.__refresher.start()
+
+    def __refresh_ahead(self):
+        """Background loop refreshing the token config.TOKEN_REFRESH_MARGIN seconds before expiry."""
+        while True:
+            with self.__lock:
+                expiry = self.creds.expiry
+            sleep(max((expiry - datetime.utcnow()).total_seconds() - config.TOKEN_REFRESH_MARGIN, 1))
+            try:
+                with self.__lock:
+                    if self.creds.expiry == expiry:
+                        self.__refresh()
+            except Exception as err:
+                self.__logger.error(f'Fail to refresh access token in advance.\n{err}')
+                sleep(60)
 
     def __write_access_token_to_file(self):
-        with open(config.ACCESS_TOKEN_FILE_PATH, 'w') as token:
+        path_to_tmp = self.__token_file_path + '.tmp'
+        with open(path_to_tmp, 'w') as token:
             token.write(self.creds.to_json())
+        os.replace(path_to_tmp, self.__token_file_path)
 
     def __get_auth(self):
         flow = InstalledAppFlow.from_client_secrets_file(
@@ -52,47 +113,76 @@ class Authentication:
 
 
 class MetadataList:
-    def __init__(self, db_conn):
-        self.__new_next_page_token = None
+    def __init__(self, db_conn, profile=None):
         self.__current_mode = '0'
-        self.__list_retrieved = False
-        self.__page = None
         self.__logger = logging.getLogger(self.__class__.__name__)
         self.__db_conn = db_conn
+        self.__profile = profile or accounts.default_profile(config)
+        self.__paths = storage.PathResolver(*self.__profile.storage_roots)
 
-    def __get_page(self, auth, next_page_token):
+    def __get_page(self, auth, page_token) -> tuple:
+        """Returns items of the page and the token of the next page, the token is None on the last page."""
         url = media.SRV_ENDPOINT + 'mediaItems'
-        objects_count_on_page = '100'
-        params = {'pageSize': objects_count_on_page,
-                  'pageToken': next_page_token}
-        representation = helpers.make_request_w_auth(auth.access_token, url, params)
-        try:
-            self.__page = representation['mediaItems']
-        except KeyError:
-            raise exceptions.NoItemsInResp(f"No mediaItems object in response. Response: {representation}")
-        try:
-            self.__new_next_page_token = representation['nextPageToken']
-        except KeyError:
-            self.__new_next_page_token = None
-            raise exceptions.NoNextPageTokenInResp("No nextPageToken object in response. Probably got end of the list.")
+        params = {'pageSize': min(config.LISTING_PAGE_SIZE, MAX_PAGE_SIZE),
+                  'pageToken': page_token}
+        representation = helpers.make_api_request(auth, url, params, quota.PRIORITY_LISTING)
+        if 'mediaItems' not in representation:
+            self.__logger.info(f"No mediaItems object in response. Response: {representation}")
+        if 'nextPageToken' not in representation:
+            self.__logger.warning("No nextPageToken object in response. Probably got end of the list.")
+        return representation.get('mediaItems', []), representation.get('nextPageToken')
 
-    def __write_page(self, mode='write_all'):
-        """
-        :param mode: 'write_all' or 'write_latest'
+    def __fetch_pages(self, auth, page_token, pages: Queue, stop: Event):
+        """Page fetcher, follows nextPageToken from page_token and puts (items, next page token) into the queue.
+
+        Puts an exception instead of the page if the request fails.
         """
-        for item in self.__page:
-            media_item = media.Item(item['id'], item['mimeType'], item['filename'],
-                                    item['mediaMetadata']['creationTime'], self.__db_conn,
-                                    config.PATH_TO_VIDEOS_STORAGE, config.PATH_TO_IMAGES_STORAGE)
+        while not stop.is_set():
             try:
-                media_item.write_to_db()
-            except exceptions.ObjAlreadyExists:
-                if mode == 'write_all':
-                    continue
-                elif mode == 'write_latest':
-                    raise
-                else:
-                    raise exceptions.MyGPhotoException('Unexpected error.')
+                page, page_token = self.__get_page(auth, page_token)
+            except Exception as err:
+                pages.put(err)
+                return
+            pages.put((page, page_token))
+            if not page_token:
+                return
+
+    def __write_page(self, page, account_info=()) -> int:
+        """Writes the page into the DB in one transaction, returns count of new items.
+
+        The media class and the target path of the items are computed here, once per item.
+
+        :param account_info: (key, value) pairs written to account_info in the same transaction,
+            the key is deleted if the value is None
+        """
+        rows = []
+        for item in page:
+            item_class = storage.media_class(item['mimeType'])
+            creation_time = item['mediaMetadata']['creationTime']
+            rows.append((item['id'], item['filename'], item['mimeType'], creation_time, item_class,
+                         self.__paths.target_path(item_class, creation_time, item['filename'])))
+        try:
+            with self.__db_conn:
+                cursor = self.__db_conn.cursor()
+                cursor.executemany('INSERT OR IGNORE INTO my_media (object_id, filename, media_type, creation_time, '
+                                   'media_class, target_path) VALUES (?, ?, ?, ?, ?, ?)', rows)
+                inserted = cursor.rowcount
+                for key, value in account_info:
+                    if value is None:
+                        cursor.execute("DELETE FROM account_info WHERE key = ?", (key,))
+                    else:
+                        cursor.execute("INSERT OR REPLACE INTO account_info (key, value) VALUES (?, ?)", (key, value))
+        except sqlite3.Error as err:
+            self.__logger.error(f'Fail to write page metadata into the DB.\n{err}')
+            raise
+        return inserted
+
+    def __get_checkpoint(self) -> tuple:
+        """Returns the page token and the count of pages written by the interrupted initial listing."""
+        cursor = self.__db_conn.cursor()
+        cursor.execute("SELECT key, value FROM account_info WHERE key IN ('list_page_token', 'list_pages')")
+        values = dict(cursor.fetchall())
+        return values.get('list_page_token'), int(values.get('list_pages', 0))
 
     def __check_mode(self):
         cursor = self.__db_conn.cursor()
@@ -107,99 +197,218 @@ class MetadataList:
             pass
 
     @staticmethod
-    def get_items_by_ids(ids: tuple, auth) -> list:
-        url = media.SRV_ENDPOINT + 'mediaItems:batchGet?' + ''.join('mediaItemIds=' + i + '&' for i in ids)
-        representation = helpers.make_request_w_auth(auth.access_token, url)
+    def get_items_by_ids(ids: tuple, auth, priority=quota.PRIORITY_DOWNLOAD) -> list:
+        """Gets up to media.BATCH_GET_LIMIT items by one mediaItems:batchGet request.
+
+        Returns mediaItemResults in the same order as ids, each result contains either
+        'mediaItem' or 'status' of the failure.
+        """
+        if len(ids) > media.BATCH_GET_LIMIT:
+            raise ValueError(f'batchGet accepts up to {media.BATCH_GET_LIMIT} ids, got {len(ids)}.')
+        url = media.SRV_ENDPOINT + 'mediaItems:batchGet'
+        params = [('mediaItemIds', item_id) for item_id in ids]
+        representation = helpers.make_api_request(auth, url, params, priority)
         try:
             items = representation['mediaItemResults']
         except KeyError:
-            raise exceptions.NoItemsInResp()
+            raise exceptions.NoItemsInResp(f"No mediaItemResults object in response. Response: {representation}")
         return items
 
-    def get_metadata_list(self, auth):
-        """Gets media metadata from Google Photo server and writes it to the local database."""
+    def get_metadata_list(self, auth) -> int:
+        """Gets media metadata from Google Photo server and writes it to the local database.
+
+        Returns count of new items.
+
+        Pages are fetched by a separate thread up to config.LISTING_PREFETCH_PAGES ahead,
+        so the network requests overlap with the DB writes.
+        The initial listing saves the next page token with every page, so it resumes after a restart.
+        Later listings stop after config.LISTING_KNOWN_PAGES_TO_STOP pages in a row without new items.
+        """
+        with metrics.PHASE_SECONDS.time(phase='listing'):
+            return self.__get_metadata_list(auth)
+
+    def __get_metadata_list(self, auth) -> int:
         self.__check_mode()
-        cursor = self.__db_conn.cursor()
-        pages = 0
-        while True:
-            try:
-                self.__get_page(auth, self.__new_next_page_token)
-            except (exceptions.NoItemsInResp, exceptions.NoNextPageTokenInResp):
-                self.__list_retrieved = True
-            except exceptions.FailGettingPage:
-                break
-            if self.__current_mode == '0':
-                self.__write_page()
-            elif self.__current_mode == '1':
-                try:
-                    self.__write_page(mode='write_latest')
-                except exceptions.ObjAlreadyExists:
+        if self.__current_mode not in ('0', '1'):
+            raise Exception('Unexpected error.')
+        page_token, processed = self.__get_checkpoint() if self.__current_mode == '0' else (None, 0)
+        if page_token:
+            self.__logger.info(f'Resuming listing from page {processed + 1}.')
+        pages = Queue(maxsize=config.LISTING_PREFETCH_PAGES)
+        stop = Event()
+        fetcher = Thread(target=self.__fetch_pages, args=(auth, page_token, pages, stop), name='page-fetcher',
+                         daemon=True)
+        fetcher.start()
+        new_items = 0
+        known_pages = 0
+        try:
+            while True:
+                fetched = pages.get()
+                if isinstance(fetched, exceptions.QuotaExceeded):
+                    self.__logger.warning('Listing is postponed till the API quota is available.')
                     break
-            else:
-                raise Exception('Unexpected error.')
-            pages += 1
-            self.__logger.info(f'{pages} - processed.')
-            if self.__list_retrieved:
-                cursor.execute("INSERT OR REPLACE INTO account_info (key, value) VALUES ('list_received', '1') ")
-                self.__db_conn.commit()
-                self.__logger.warning('List of media has been retrieved.')
-                break
+                if isinstance(fetched, exceptions.FailGettingPage):
+                    break
+                if isinstance(fetched, Exception):
+                    # Only a rejected page token drops the checkpoint, the listing resumes from it after other failures.
+                    if isinstance(fetched, exceptions.InvalidArgument) and page_token and not new_items:
+                        self.__logger.warning('Fail to resume listing, it will start over next time.')
+                        self.__write_page((), (('list_page_token', None), ('list_pages', None)))
+                    raise fetched
+                page, next_page_token = fetched
+                processed += 1
+                if not next_page_token:
+                    account_info = (('list_received', '1'), ('list_page_token', None), ('list_pages', None))
+                elif self.__current_mode == '0':
+                    account_info = (('list_page_token', next_page_token), ('list_pages', str(processed)))
+                else:
+                    account_info = ()
+                started = monotonic()
+                with metrics.DB_SECONDS.time(operation='listing_page'):
+                    inserted = self.__write_page(page, account_info)
+                elapsed = monotonic() - started
+                auth.quota.checkpoint(self.__db_conn)
+                metrics.LISTING_PAGES.inc()
+                metrics.LISTING_ITEMS.inc(inserted, new='1')
+                metrics.LISTING_ITEMS.inc(len(page) - inserted, new='0')
+                metrics.ACCOUNT_ITEMS.inc(inserted, account=self.__profile.name, result='listed')
+                new_items += inserted
+                self.__logger.info('%d - processed, %d of %d items are new, %d duplicates skipped, %.0f rows/s.',
+                                   processed, inserted, len(page), len(page) - inserted,
+                                   len(page) / elapsed if elapsed else 0)
+                if not next_page_token:
+                    self.__logger.warning('List of media has been retrieved.')
+                    break
+                known_pages = 0 if inserted else known_pages + 1
+                if self.__current_mode == '1' and known_pages >= config.LISTING_KNOWN_PAGES_TO_STOP:
+                    break
+        finally:
+            stop.set()
+            while fetcher.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except Empty:
+                    pass
+            auth.quota.save(self.__db_conn)
+        return new_items
 
 
 class LocalStorage:
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, profile=None, executor=None):
+        """
+        :param profile: accounts.Profile of the account, the default profile of config if it is not set
+        :param executor: download thread pool shared with other accounts, a pool per run is used if it is not set
+        """
         self.__logger = logging.getLogger(self.__class__.__name__)
         self.__db_conn = db_conn
-        self.__download_selection = None
-        self.__actualization_selection = None
+        self.__profile = profile or accounts.default_profile(config)
+        self.__executor = executor
+        self.__created_folders = set()
+        self.__outcomes = Counter()
+        self.__paused = None
         self.__last_actualization_date = None
 
-    def __get_download_selection(self):
-        try:
+    def __update_download_queue(self):
+        """Adds items waiting for download to the queue and drops the ones that are not waiting anymore.
+
+        Items of an unexpected mime type have no target path and are not queued.
+        """
+        with self.__db_conn:
             cursor = self.__db_conn.cursor()
-            cursor.execute("SELECT object_id, media_type, filename, creation_time FROM my_media "
-                           "WHERE stored = '0' ORDER BY creation_time DESC")
+            cursor.execute("DELETE FROM download_queue WHERE object_id NOT IN "
+                           "(SELECT object_id FROM my_media WHERE stored = '0')")
+            cursor.execute("INSERT OR IGNORE INTO download_queue (object_id, priority) "
+                           "SELECT object_id, CASE WHEN media_class = ? THEN ? ELSE ? END "
+                           "FROM my_media WHERE stored = '0' AND target_path IS NOT NULL",
+                           (storage.VIDEO, QUEUE_LARGE, QUEUE_SMALL))
+
+    def __iter_download_queue(self, priority, previews=False):
+        """Yields queued items of the priority that are due, newest first.
+
+        Only the items without a preview are yielded if previews is set, their due time is the one of the preview.
+        Reads them by keyset pages of SELECTION_PAGE_SIZE rows.
+        """
+        cursor = self.__db_conn.cursor()
+        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        query = ("SELECT m.id, m.creation_time, m.object_id, m.media_class, m.filename, m.target_path, "
+                 "m.preview_path, q.size FROM my_media AS m "
+                 "JOIN download_queue AS q ON q.object_id = m.object_id WHERE m.stored = '0' AND q.priority = ? "
+                 + ("AND m.preview_path IS NULL AND (q.preview_next_retry_at IS NULL OR q.preview_next_retry_at <= ?) "
+                    if previews else "AND (q.next_retry_at IS NULL OR q.next_retry_at <= ?) ") +
+                 "{} ORDER BY m.creation_time DESC, m.id DESC LIMIT ?")
+        try:
+            cursor.execute(query.format(''), (priority, now, SELECTION_PAGE_SIZE))
+            rows = cursor.fetchall()
+            while rows:
+                yield from (row[2:] for row in rows)
+                last_id, last_creation_time = rows[-1][0], rows[-1][1]
+                cursor.execute(query.format("AND m.creation_time <= ? AND (m.creation_time < ? OR m.id < ?)"),
+                               (priority, now, last_creation_time, last_creation_time, last_id,
+                                SELECTION_PAGE_SIZE))
+                rows = cursor.fetchall()
         except sqlite3.Error as err:
             self.__logger.error(f'Fail to communicate with DB.\n{err}')
             raise
-        self.__download_selection = cursor.fetchall()
-
-    def __create_tree(self):
-        sub_folders = set()
-        for item in self.__download_selection:
-            year = datetime.strptime(item[3], "%Y-%m-%dT%H:%M:%SZ").year
-            sub_folders.add(str(year))
-        for item in sub_folders:
-            if not os.path.exists(config.PATH_TO_IMAGES_STORAGE + item):
-                try:
-                    os.makedirs(config.PATH_TO_IMAGES_STORAGE + item)
-                except OSError as err:
-                    self.__logger.error(f"Fail to create folder, {err}")
-                    raise
-                self.__logger.info(f"Folder {config.PATH_TO_IMAGES_STORAGE + item} has been created.")
-            if not os.path.exists(config.PATH_TO_VIDEOS_STORAGE + item):
-                try:
-                    os.makedirs(config.PATH_TO_VIDEOS_STORAGE + item)
-                except OSError as err:
-                    self.__logger.error(f"Fail to create folder, {err}")
-                    raise
-                self.__logger.info(f"Folder {config.PATH_TO_VIDEOS_STORAGE + item} has been created.")
 
-    def __get_actualization_selection(self, limit=5, start_from=None):  # TODO
+    def __postpone(self, media_item, reason):
+        """Puts off the next attempt to download the item with exponential backoff.
+
+        A failed preview puts off only the next preview, the original is retried on its own schedule.
+        """
+        previews = bool(media_item.preview_size)
         cursor = self.__db_conn.cursor()
-        cursor.execute("SELECT value FROM account_info WHERE key = 'last_processed_object_id'")
-        last_local_id_processed = cursor.fetchall()
-        cursor.execute("DELETE from account_info WHERE key = 'last_processed_object_id'")
-        self.__db_conn.commit()
+        cursor.execute("SELECT preview_attempts FROM download_queue WHERE object_id = ?" if previews else
+                       "SELECT attempts FROM download_queue WHERE object_id = ?", (media_item.id,))
+        row = cursor.fetchone()
+        attempts = (row[0] if row else 0) + 1
+        delay = min(config.DOWNLOAD_RETRY_BASE_DELAY * 2 ** (attempts - 1), config.DOWNLOAD_RETRY_MAX_DELAY)
+        next_retry_at = (datetime.utcnow() + timedelta(seconds=delay)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        metrics.DOWNLOAD_ITEMS.inc(result='postponed')
+        metrics.ACCOUNT_ITEMS.inc(account=self.__profile.name, result='postponed')
+        self.__outcomes['postponed'] += 1
+        with metrics.DB_SECONDS.time(operation='postpone'), self.__db_conn:
+            if previews:
+                cursor.execute("UPDATE download_queue SET preview_attempts = ?, preview_next_retry_at = ? "
+                               "WHERE object_id = ?", (attempts, next_retry_at, media_item.id))
+            else:
+                size = media_item.size
+                large = media_item.is_video or (size or 0) > config.LARGE_FILE_SIZE
+                cursor.execute("UPDATE download_queue SET attempts = ?, next_retry_at = ?, size = COALESCE(?, size), "
+                               "priority = ? WHERE object_id = ?",
+                               (attempts, next_retry_at, size, QUEUE_LARGE if large else QUEUE_SMALL,
+                                media_item.id))
+        self.__logger.info('%s %s, attempt %d, next one after %s.', media_item.filename, reason, attempts,
+                           next_retry_at)
+
+    def __make_folder(self, path):
+        """Creates the folder on first use, the result is cached for the object lifetime."""
+        if path in self.__created_folders:
+            return
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                self.__logger.error(f"Fail to create folder, {err}")
+                raise
+            self.__logger.info(f"Folder {path} has been created.")
+        self.__created_folders.add(path)
+
+    def __iter_actualization_selection(self):
+        """Yields (id, object_id, media_class, filename, target_path, local_path) of stored items after checkpoint."""
+        cursor = self.__db_conn.cursor()
+        cursor.execute("SELECT value FROM account_info WHERE key = 'last_processed_id'")
+        last_id_processed = cursor.fetchone()
+        last_id = int(last_id_processed[0]) if last_id_processed else 0
         not_before = datetime.now() - timedelta(days=config.ACTUALIZATION_NOT_OLD)
-        if not last_local_id_processed:
-            cursor.execute("SELECT object_id, media_type, filename, creation_time FROM my_media WHERE stored != '0' \
-                           and creation_time > ? ORDER BY id;", (not_before.strftime("%Y-%m-%d"),))
-        else:
-            cursor.execute("SELECT object_id, media_type, filename, creation_time FROM my_media WHERE stored != '0' and\
-                           id > (SELECT id FROM my_media WHERE object_id = ?) and creation_time > ? ORDER BY id",
-                           (last_local_id_processed[0][0], not_before.strftime("%Y-%m-%d")))
-        self.__actualization_selection = cursor.fetchall()
+        while True:
+            cursor.execute("SELECT id, object_id, media_class, filename, target_path, local_path FROM my_media "
+                           "WHERE stored != '0' and id > ? and creation_time > ? ORDER BY id LIMIT ?",
+                           (last_id, not_before.strftime("%Y-%m-%d"), SELECTION_PAGE_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
 
     def __get_last_actualization(self):
         cursor = self.__db_conn.cursor()
@@ -226,113 +435,637 @@ class LocalStorage:
         cursor.execute(f"INSERT OR REPLACE INTO account_info (key, value) VALUES ('last_actualization', '{now}')")
         self.__db_conn.commit()
 
-    def __write_last_processed(self, item_id):
-        cursor = self.__db_conn.cursor()
-        cursor.execute("INSERT INTO account_info (key, value) "
-                       "VALUES('last_processed_object_id', ?)", (item_id,))
-        self.__db_conn.commit()
+    def __remove_chunk(self, rows, auth):
+        """Checks a chunk of items by one batchGet request and removes the ones missing on the server.
 
-    def remove_not_existing(self, auth) -> bool:  # TODO: use batchGet
-        self.__get_actualization_selection()
-        for item in self.__actualization_selection:
-            media_item = media.Item(*item, self.__db_conn, config.PATH_TO_VIDEOS_STORAGE, config.PATH_TO_IMAGES_STORAGE)
-            try:
-                result = media_item.is_exist_on_server(auth)
-            except (Exception, KeyboardInterrupt):
-                self.__write_last_processed(media_item.id)
-                raise
-            if not result:
+        Deletions and the checkpoint are committed in one transaction.
+        """
+        media_items = [media.Item(*row[1:]) for row in rows]
+        results = MetadataList.get_items_by_ids(tuple(media_item.id for media_item in media_items), auth,
+                                                quota.PRIORITY_ACTUALIZATION)
+        auth.quota.checkpoint(self.__db_conn)
+        not_existing = [media_item for media_item, result in zip(media_items, results)
+                        if result.get('status', {}).get('code') == media.STATUS_NOT_FOUND]
+        removed_ids = {media_item.id for media_item in not_existing}
+        cursor = self.__db_conn.cursor()
+        removed_paths = set()
+        for media_item in not_existing:
+            if media_item.path in removed_paths:
+                continue
+            # A duplicate shares the file with another item, the file is kept while it is referenced.
+            # Items stored before local_path was added refer to their file by target_path only.
+            cursor.execute("SELECT object_id FROM my_media WHERE stored != '0' AND "
+                           "COALESCE(local_path, target_path) = ?", (media_item.path,))
+            if not {object_id for (object_id,) in cursor.fetchall()} - removed_ids:
                 media_item.remove_from_local()
-                media_item.remove_from_db()
-                self.__logger.info(f"{media_item.filename} removed from local and db.")
+                removed_paths.add(media_item.path)
+        metrics.ACTUALIZATION_ITEMS.inc(len(not_existing), result='removed')
+        metrics.ACTUALIZATION_ITEMS.inc(len(rows) - len(not_existing), result='exists')
+        with metrics.DB_SECONDS.time(operation='actualization_chunk'), self.__db_conn:
+            cursor.executemany("DELETE FROM my_media WHERE object_id=?",
+                               ((media_item.id,) for media_item in not_existing))
+            cursor.executemany("DELETE FROM content_index WHERE path=?", ((path,) for path in removed_paths))
+            cursor.execute("INSERT OR REPLACE INTO account_info (key, value) VALUES ('last_processed_id', ?)",
+                           (str(rows[-1][0]),))
+        for media_item in not_existing:
+            self.__logger.debug('%s removed from local and db.', media_item.filename)
+        if not_existing:
+            self.__logger.info('%d of %d checked items removed from local and db.', len(not_existing), len(rows))
+
+    def remove_not_existing(self, auth) -> bool:
+        """Removes items that no longer exist on the server from the local storage and the DB.
+
+        Items are checked by batchGet in chunks of media.BATCH_GET_LIMIT, the checkpoint advances
+        per chunk, so an interrupted run resumes from the last completed chunk.
+        Returns False if the run is postponed because the API quota share of actualization is used.
+        """
+        with metrics.PHASE_SECONDS.time(phase='actualization'):
+            return self.__remove_not_existing(auth)
+
+    def __remove_not_existing(self, auth) -> bool:
+        selection = self.__iter_actualization_selection()
+        try:
+            while True:
+                rows = list(islice(selection, media.BATCH_GET_LIMIT))
+                if not rows:
+                    break
+                self.__remove_chunk(rows, auth)
+        except exceptions.QuotaExceeded:
+            self.__logger.warning('Actualization is postponed till the API quota is available.')
+            return False
+        finally:
+            auth.quota.save(self.__db_conn)
+        cursor = self.__db_conn.cursor()
+        cursor.execute("DELETE FROM account_info WHERE key = 'last_processed_id'")
         self.__set_last_actualization_date()
         return True
 
-    def download_media_items(self, auth):
-        """Downloads media items that listed in the database putting it by year's folder."""
-        self.__get_download_selection()
+    def __resolve_base_urls(self, items, auth, preview_size=None) -> list:
+        """Resolves baseUrls for a chunk of selected items by one batchGet request.
+
+        Items missing on the server are removed from the DB along with their previews,
+        returns media items ready to download, the previews of them if preview_size is set.
+        """
+        media_items = []
+        for item in items:
+            media_item = media.Item(*item[:4], preview_path=item[4])
+            media_item.preview_size = preview_size
+            if not preview_size:
+                media_item.size = item[5]
+            media_items.append(media_item)
         try:
-            self.__create_tree()
-        except OSError:
-            self.__logger.error("Please check storage paths in config.")
-            raise
-        for item in self.__download_selection:
-            media_item = media.Item(*item, self.__db_conn,
-                                    config.PATH_TO_VIDEOS_STORAGE, config.PATH_TO_IMAGES_STORAGE)
-            try:
-                media_item.get_base_url(auth)
-            except FileNotFoundError:
-                self.__logger.warning(f"Item {item[2]} not found on the server, removing from database.")
-                media_item.remove_from_db()
-                continue
-            except exceptions.VideoNotReady:
-                continue
+            with metrics.BASE_URL_SECONDS.time():
+                results = MetadataList.get_items_by_ids(tuple(media_item.id for media_item in media_items), auth)
+        except exceptions.NoItemsInResp as err:
+            err.log(self.__logger)
+            return []
+        finally:
+            auth.quota.checkpoint(self.__db_conn)
+        resolved = []
+        not_found = []
+        for media_item, result in zip(media_items, results):
+            metrics.BASE_URLS.inc(result='found' if 'mediaItem' in result else
+                                  result.get('status', {}).get('code', 'unknown'))
+            if 'mediaItem' in result:
+                try:
+                    media_item.set_base_url(result['mediaItem'])
+                except exceptions.VideoNotReady:
+                    self.__postpone(media_item, 'is not ready')
+                    continue
+                except KeyError:
+                    self.__postpone(media_item, 'has no baseUrl')
+                    continue
+                resolved.append(media_item)
+            elif result.get('status', {}).get('code') == media.STATUS_NOT_FOUND:
+                self.__logger.warning('Item %s not found on the server, removing from database.', media_item.filename)
+                not_found.append((media_item.id,))
+                if media_item.preview_path:
+                    self.__remove_preview(media_item)
+            else:
+                self.__logger.warning('Fail to get %s from the server. Result: %s', media_item.filename, result)
+        if not_found:
+            with self.__db_conn:
+                self.__db_conn.executemany("DELETE FROM my_media WHERE object_id=?", not_found)
+        return resolved
+
+    @staticmethod
+    def __fetch_media_item(media_item, stats) -> int:
+        """Download worker, works with network and file system only, the DB is left to the caller."""
+        started = monotonic()
+        written = media_item.download(config.DOWNLOAD_CHUNK_SIZE)
+        elapsed = monotonic() - started
+        stats.record(current_thread().name, 1, written, elapsed)
+        metrics.DOWNLOAD_SECONDS.observe(elapsed, media=media_item.media_class)
+        return written
+
+    def __remove_preview(self, media_item):
+        try:
+            os.remove(media_item.preview_path)
+        except OSError as err:
+            self.__logger.warning('Fail to remove preview of %s, %s', media_item.filename, err)
+
+    def __store_preview(self, media_item):
+        path = dedup.free_path(media_item.download_path)
+        os.replace(media_item.path_to_part, path)
+        metrics.DOWNLOAD_ITEMS.inc(result='preview')
+        metrics.ACCOUNT_ITEMS.inc(account=self.__profile.name, result='preview')
+        self.__outcomes['preview'] += 1
+        with metrics.DB_SECONDS.time(operation='store'), self.__db_conn:
+            self.__db_conn.execute("UPDATE my_media SET preview_path=? WHERE object_id=?", (path, media_item.id))
+
+    def __downloaded_today(self) -> int:
+        """Returns bytes of originals downloaded by the account today, the day is counted in UTC."""
+        cursor = self.__db_conn.cursor()
+        cursor.execute("SELECT key, value FROM account_info WHERE key IN ('download_bytes_day', 'download_bytes_used')")
+        values = dict(cursor.fetchall())
+        if values.get('download_bytes_day') != datetime.utcnow().strftime('%Y-%m-%d'):
+            return 0
+        return int(values.get('download_bytes_used', 0))
+
+    def __store_media_file(self, media_item, written):
+        """Moves the downloaded part into the storage and records it in the DB and the content index.
+
+        A byte-identical file that is already indexed is not stored twice, the item refers to that file
+        or gets a hard link to it if config.DEDUP_HARD_LINKS is set. A different file with the same name
+        gets a free 'name_N.ext' name, so does the link. The preview of the item, if any, is removed.
+        Written bytes are added to the bytes downloaded today in the same transaction.
+        """
+        size = os.path.getsize(media_item.path_to_part)
+        duplicate = dedup.find_duplicate(self.__db_conn, media_item.content_hash, size)
+        if duplicate:
+            os.remove(media_item.path_to_part)
+            path, stored = duplicate, '2'
+            if config.DEDUP_HARD_LINKS:
+                link_path = dedup.free_path(media_item.target_path)
+                try:
+                    os.link(duplicate, link_path)
+                    path, stored = link_path, '1'
+                except OSError as err:
+                    self.__logger.warning(f"Fail to link {media_item.filename} to {duplicate}, {err}")
+            self.__logger.debug('Media file %s is a duplicate of %s.', media_item.filename, duplicate)
+        else:
+            path, stored = dedup.free_path(media_item.target_path), '1'
+            os.replace(media_item.path_to_part, path)
+            self.__logger.debug('Media file %s stored as %s.', media_item.filename, path)
+        metrics.DOWNLOAD_ITEMS.inc(result='duplicate' if duplicate else 'stored')
+        metrics.ACCOUNT_ITEMS.inc(account=self.__profile.name, result='duplicate' if duplicate else 'stored')
+        self.__outcomes['duplicate' if duplicate else 'stored'] += 1
+        with metrics.DB_SECONDS.time(operation='store'), self.__db_conn:
+            if stored == '1':
+                dedup.add_to_index(self.__db_conn, path, media_item.content_hash, size)
+            self.__db_conn.execute("UPDATE my_media SET stored=?, local_path=?, preview_path=NULL WHERE object_id=?",
+                                   (stored, path, media_item.id))
+            self.__db_conn.execute("DELETE FROM download_queue WHERE object_id=?", (media_item.id,))
+            self.__db_conn.executemany("INSERT OR REPLACE INTO account_info (key, value) VALUES (?, ?)",
+                                       (('download_bytes_used', str(self.__downloaded_today() + written)),
+                                        ('download_bytes_day', datetime.utcnow().strftime('%Y-%m-%d'))))
+        if media_item.preview_path:
+            self.__remove_preview(media_item)
+
+    def __process_download_result(self, media_item, future):
+        """Applies a download outcome to the DB, it is called from the thread owning the DB connection only."""
+        try:
+            written = future.result()
+        except exceptions.DownloadError as err:
+            err.log(self.__logger)
+            self.__postpone(media_item, 'failed to download')
+            return
+        except OSError as err:
+            if err.errno == errno.ENOSPC:
+                # The item stays queued as is, it is not the one to blame.
+                self.__paused = f'{err.strerror} while downloading {media_item.filename}.'
+                return
+            self.__postpone(media_item, f'failed to download ({err.__class__.__name__})')
+            return
+        except Exception:
+            # A failure of one item must not abort the run, it is retried with backoff like the others.
+            self.__logger.exception('Unexpected failure of %s download.', media_item.filename)
+            self.__postpone(media_item, 'failed to download')
+            return
+        metrics.ACCOUNT_BYTES.inc(written, account=self.__profile.name)
+        try:
+            if media_item.preview_size:
+                self.__store_preview(media_item)
+            else:
+                self.__outcomes['bytes'] += written
+                self.__store_media_file(media_item, written)
+        except OSError as err:
+            self.__logger.error('Fail to store %s, %s', media_item.filename, err)
+
+    def reconcile(self) -> list:
+        """Checks stored items against the files in the media storage.
+
+        Items whose file is missing are reset to stored='0' to be downloaded again.
+        Returns orphaned files, the ones that no item refers to.
+        """
+        roots = self.__profile.storage_roots
+        started = monotonic()
+        files = storage.scan_tree(roots, config.DOWNLOAD_WORKERS)
+        self.__logger.info(f'{len(files)} files found in {monotonic() - started:.1f} s.')
+        cursor = self.__db_conn.cursor()
+        with self.__db_conn:
+            cursor.execute("CREATE TEMP TABLE local_files (path TEXT PRIMARY KEY)")
+            cursor.executemany("INSERT OR IGNORE INTO local_files (path) VALUES (?)", ((path,) for path in files))
+            cursor.execute("CREATE TEMP TABLE media_paths AS "
+                           "SELECT object_id, COALESCE(local_path, target_path) AS path FROM my_media "
+                           "WHERE stored != '0'")
+            cursor.execute("CREATE INDEX temp.media_paths_path ON media_paths (path)")
+            cursor.execute("DELETE FROM content_index WHERE path IN (SELECT m.path FROM media_paths AS m "
+                           "LEFT JOIN local_files AS f ON f.path = m.path WHERE f.path IS NULL)")
+            cursor.execute("UPDATE my_media SET stored = '0', local_path = NULL WHERE object_id IN "
+                           "(SELECT m.object_id FROM media_paths AS m "
+                           "LEFT JOIN local_files AS f ON f.path = m.path WHERE f.path IS NULL)")
+            missing = cursor.rowcount
+            cursor.execute("SELECT f.path FROM local_files AS f "
+                           "LEFT JOIN media_paths AS m ON m.path = f.path WHERE m.path IS NULL ORDER BY f.path")
+            orphans = [path for (path,) in cursor.fetchall()]
+            cursor.execute("DROP TABLE temp.local_files")
+            cursor.execute("DROP TABLE temp.media_paths")
+        self.__logger.info(f'Reconciliation is complete in {monotonic() - started:.1f} s: {missing} items are '
+                           f'missing in local storage and reset for download, {len(orphans)} orphaned files.')
+        return orphans
+
+    def index_local_storage(self) -> int:
+        """Adds files of the media storage to the content index, so duplicates of them are not downloaded."""
+        return dedup.index_tree(self.__db_conn, self.__profile.storage_roots, config.DOWNLOAD_WORKERS)
+
+    def download_media_items(self, auth, limit=None) -> int:
+        """Downloads media items that listed in the database putting it by year's folder.
+
+        Processes up to limit items if it is set, returns count of processed items.
+
+        Items are taken from the download queue newest first, skipping the ones waiting for a retry.
+        Videos and large files use up to config.DOWNLOAD_LARGE_SLOTS of config.DOWNLOAD_WORKERS
+        threads, the rest drain small files, large files take all threads once small ones are done.
+        BaseUrls are resolved by batchGet just before the items are queued.
+        Results are written to the DB by the calling thread only.
+        In a pool shared by several accounts each of them keeps up to config.DOWNLOAD_WORKERS items queued,
+        the pool runs them in submission order, so the accounts take turns.
+        In preview mode (config.PREVIEW_MODE) reduced-size previews of the whole backlog are downloaded first,
+        originals are backfilled by the rest of the run.
+        """
+        with metrics.PHASE_SECONDS.time(phase='download'):
+            return self.__download_media_items(auth, limit)
+
+    def __download_media_items(self, auth, limit) -> int:
+        self.__update_download_queue()
+        self.__outcomes.clear()
+        processed = 0
+        stopped = False
+        if config.PREVIEW_MODE:
+            processed, stopped = self.__download_tier(auth, limit, (config.PREVIEW_WIDTH, config.PREVIEW_HEIGHT))
+        if not stopped and (limit is None or processed < limit):
+            processed += self.__download_tier(auth, None if limit is None else limit - processed)[0]
+        self.__logger.info('Getting media items is complete: %d previews, %d stored, %d duplicates, %d postponed, '
+                           '%.1f MiB of originals.', self.__outcomes['preview'], self.__outcomes['stored'],
+                           self.__outcomes['duplicate'], self.__outcomes['postponed'],
+                           self.__outcomes['bytes'] / 2 ** 20)
+        return processed
+
+    def __download_tier(self, auth, limit, preview_size=None) -> tuple:
+        """Downloads the originals or, if preview_size is set, the previews of the items without one.
+
+        Originals are not started once config.DOWNLOAD_BYTES_PER_DAY bytes of them are downloaded today
+        by the account, the count is kept in the DB, so it holds across runs and restarts.
+        Previews are small, they take all threads regardless of the queue priority.
+        Each download is admitted by admission.controller against the bandwidth window and the free space
+        for its expected size: the queued size, config.LARGE_FILE_SIZE for large items not tried yet,
+        config.DOWNLOAD_EXPECTED_SIZE for small ones. Once one is refused or the storage gets full
+        the tier stops starting downloads and leaves the rest queued as is, instead of failing them one by one.
+        Returns count of processed items and whether the tier is stopped by the API quota or the admission.
+        """
+        stats = helpers.ThroughputStats()
+        previews = preview_size is not None
+        streams = {priority: self.__iter_download_queue(priority, previews) for priority in (QUEUE_SMALL, QUEUE_LARGE)}
+        large_slots = config.DOWNLOAD_WORKERS if previews else config.DOWNLOAD_LARGE_SLOTS
+        # Large files are resolved by small batches, so their baseUrls do not expire while waiting for a slot.
+        batch_sizes = {QUEUE_SMALL: media.BATCH_GET_LIMIT,
+                       QUEUE_LARGE: min(media.BATCH_GET_LIMIT, large_slots * 2)}
+        byte_budget = None
+        if not previews and config.DOWNLOAD_BYTES_PER_DAY is not None:
+            byte_budget = config.DOWNLOAD_BYTES_PER_DAY - self.__downloaded_today()
+        ready = {QUEUE_SMALL: deque(), QUEUE_LARGE: deque()}
+        processed = 0
+        quota_exceeded = False
+        over_budget = False
+        self.__paused = None
+        in_flight = {}
+
+        def has_ready(priority) -> bool:
+            nonlocal processed, streams, quota_exceeded
+            while not ready[priority]:
+                batch_size = batch_sizes[priority] if limit is None else min(batch_sizes[priority], limit - processed)
+                items = list(islice(streams[priority], batch_size))
+                if not items:
+                    return False
+                try:
+                    ready[priority].extend(self.__resolve_base_urls(items, auth, preview_size))
+                except exceptions.QuotaExceeded:
+                    self.__logger.warning('Downloading is stopped till the API quota is available.')
+                    streams = {QUEUE_SMALL: iter(()), QUEUE_LARGE: iter(())}
+                    quota_exceeded = True
+                    return False
+                processed += len(items)
+            return True
+
+        with ExitStack() as stack:
+            # A pool of the run is shut down on exit, the shared one is left running.
+            executor = self.__executor or stack.enter_context(
+                ThreadPoolExecutor(max_workers=config.DOWNLOAD_WORKERS, thread_name_prefix='downloader'))
             try:
-                media_item.download()
-            except (FileExistsError, OSError):
-                continue
-            except exceptions.DownloadError:
-                sleep(30)
-        self.__logger.info('Getting media items is complete.')
+                while True:
+                    while len(in_flight) < config.DOWNLOAD_WORKERS and not self.__paused:
+                        if byte_budget is not None and self.__outcomes['bytes'] >= byte_budget:
+                            over_budget = True
+                            break
+                        large_in_flight = sum(1 for _, priority in in_flight.values() if priority == QUEUE_LARGE)
+                        if large_in_flight < large_slots and has_ready(QUEUE_LARGE):
+                            priority = QUEUE_LARGE
+                        elif has_ready(QUEUE_SMALL):
+                            priority = QUEUE_SMALL
+                        elif has_ready(QUEUE_LARGE):
+                            priority = QUEUE_LARGE
+                        else:
+                            break
+                        media_item = ready[priority].popleft()
+                        try:
+                            self.__make_folder(os.path.dirname(media_item.download_path))
+                        except OSError:
+                            self.__logger.error("Please check storage paths in config.")
+                            raise
+                        if previews:
+                            expected_size = PREVIEW_EXPECTED_SIZE
+                        elif media_item.size:
+                            expected_size = media_item.size
+                        else:
+                            expected_size = (config.LARGE_FILE_SIZE if priority == QUEUE_LARGE
+                                             else config.DOWNLOAD_EXPECTED_SIZE)
+                        try:
+                            reservation = admission.controller.admit(os.path.dirname(media_item.download_path),
+                                                                     expected_size)
+                        except exceptions.DownloadsPaused as err:
+                            ready[priority].appendleft(media_item)
+                            self.__paused = err.message
+                            break
+                        future = executor.submit(self.__fetch_media_item, media_item, stats)
+                        # Called on cancel too, so a reservation is never leaked.
+                        future.add_done_callback(lambda _, reservation=reservation:
+                                                 admission.controller.release(reservation))
+                        in_flight[future] = (media_item, priority)
+                    if not in_flight:
+                        break
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.__process_download_result(in_flight.pop(future)[0], future)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                raise
+            finally:
+                stats.log_summary(self.__logger)
+                auth.quota.save(self.__db_conn)
+        # Resolved items that were not started, over the byte budget or paused, are left for the next run.
+        processed -= sum(len(items) for items in ready.values())
+        if over_budget:
+            self.__logger.info('Downloading of originals is stopped till tomorrow, DOWNLOAD_BYTES_PER_DAY is used.')
+        if self.__paused:
+            items, size = admission.controller.stats()
+            self.__logger.warning('Downloading is paused: %s %d downloads of %.1f MiB are in flight.',
+                                  self.__paused, items, size / 2 ** 20)
+        return processed, quota_exceeded or bool(self.__paused)
 
 
-class Main:
-    def __init__(self):
-        logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(funcName)s: %(message)s',
-                            filename=config.LOG_FILE_PATH,
-                            filemode='a', level=logging.INFO)
-        self.logger = logging.getLogger(self.__class__.__name__)
+class AccountSync:
+    """Listing, download and actualization of one account.
+
+    The DB connection is opened by open() in the thread running the sync and is used by that thread only.
+    """
+
+    def __init__(self, profile, api_quota=None, executor=None):
+        self.profile = profile
+        self.logger = logging.getLogger(f'Account {profile.name}')
+        self.phase = 'idle'
+        self.__executor = executor
         if not self.__is_db_exists():
             self.__db_creation()
-        self.db_conn = helpers.db_connect(config.DB_FILE_PATH)
-        self.authentication = Authentication()
-        self.metadata = MetadataList(self.db_conn)
-        self.local_storage = LocalStorage(self.db_conn)
+        self.authentication = Authentication(profile, api_quota)
+        self.db_conn = None
+        self.metadata = None
+        self.local_storage = None
+        self.scheduler = scheduler.Scheduler()
 
     def __is_db_exists(self) -> bool:
-        if not os.path.exists(config.DB_FILE_PATH):
-            message = f'DB {config.DB_FILE_PATH} does not exist.'
+        if not os.path.exists(self.profile.db_file_path):
+            message = f'DB {self.profile.db_file_path} does not exist.'
             print(message)
             self.logger.error(message)
             return False
         return True
 
     def __db_creation(self):
-        answer = input('Do you want to create new DB?(Y/n)')
+        answer = input(f'Do you want to create new DB for account {self.profile.name}?(Y/n)')
         if answer == 'n' or answer == 'N':
             self.logger.warning('Aborted by user.')
             exit(3)
         try:
-            shutil.copy('db/db.sqlite.structure', config.DB_FILE_PATH)
+            shutil.copy('db/db.sqlite.structure', self.profile.db_file_path)
         except OSError as err:
             message = f'Fail to create DB.\n{err}'
             print(message)
             self.logger.error(message)
             exit(4)
 
+    def open(self):
+        self.db_conn = helpers.db_connect(self.profile.db_file_path)
+        helpers.db_migrate(self.db_conn, DB_MIGRATIONS_PATH)
+        storage.PathResolver(*self.profile.storage_roots).backfill(self.db_conn)
+        self.authentication.quota.load(self.db_conn)
+        self.metadata = MetadataList(self.db_conn, self.profile)
+        self.local_storage = LocalStorage(self.db_conn, self.profile, self.__executor)
+
+    def close(self):
+        if self.db_conn:
+            self.db_conn.close()
+
+    def progress(self) -> str:
+        name = self.profile.name
+        listed, previews, stored, duplicates, postponed = (
+            metrics.ACCOUNT_ITEMS.value(account=name, result=result)
+            for result in ('listed', 'preview', 'stored', 'duplicate', 'postponed'))
+        size = metrics.ACCOUNT_BYTES.value(account=name) / 2 ** 20
+        return (f'{name}: {self.phase}, {listed} listed, {previews} previews, {stored} stored, '
+                f'{duplicates} duplicates, {postponed} postponed, {size:.1f} MiB.')
+
+    def __run_phase(self, phase, func, *args):
+        self.phase = phase
+        try:
+            return func(*args)
+        finally:
+            self.phase = 'idle'
+
+    def __listing_job(self) -> bool:
+        if self.__run_phase('listing', self.metadata.get_metadata_list, self.authentication):
+            self.scheduler.wake('download')
+        return False
+
+    def __download_job(self) -> bool:
+        limit = config.DOWNLOAD_ITEMS_PER_RUN
+        return self.__run_phase('download', self.local_storage.download_media_items, self.authentication,
+                                limit) == limit
+
+    def __actualization_job(self) -> bool:
+        if self.local_storage.is_actualization_needed():
+            self.logger.info("Start local DB and storage actualization.")
+            self.__run_phase('actualization', self.local_storage.remove_not_existing, self.authentication)
+            self.logger.info('Actualization is complete.')
+        return False
+
+    def sync(self):
+        """Runs listing, download and actualization once."""
+        self.__run_phase('listing', self.metadata.get_metadata_list, self.authentication)
+        self.logger.info('Start downloading a list of media items.')
+        self.__run_phase('download', self.local_storage.download_media_items, self.authentication)
+        self.__actualization_job()
+
+    def run_forever(self, stop=None):
+        """Runs listing, download and actualization as scheduler jobs until stop is set or interrupted."""
+        self.scheduler.add_job('listing', self.__listing_job, config.LISTING_INTERVAL, config.LISTING_MAX_INTERVAL)
+        self.scheduler.add_job('download', self.__download_job, config.DOWNLOAD_INTERVAL,
+                               config.DOWNLOAD_MAX_INTERVAL)
+        self.scheduler.add_job('actualization', self.__actualization_job, config.ACTUALIZATION_CHECK_INTERVAL)
+        self.scheduler.run_forever(stop)
+
+    def run(self, daemon, stop):
+        """Thread target of the multi-account mode, the DB is opened and closed by the thread."""
+        try:
+            self.open()
+            if daemon:
+                self.run_forever(stop)
+            else:
+                self.sync()
+        except Exception as err:
+            self.logger.exception(f'Something went wrong.\n{err}')
+        finally:
+            self.close()
+
+
+class Main:
+    """Syncs the accounts of config, the default one or each of config.ACCOUNTS.
+
+    Accounts share the HTTP session, the rate limiter and the daily API quota of the client id.
+    Several accounts are synced concurrently by a thread each and share one download pool.
+    """
+
+    def __init__(self):
+        helpers.init_logging(config.LOG_FILE_PATH)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        profiles = accounts.load_profiles(config)
+        helpers.init_http_session(config.HTTP_POOL_SIZE, config.HTTP_RETRIES, config.HTTP_BACKOFF_FACTOR,
+                                  config.HTTP_TIMEOUT)
+        quota.init_rate_limiter(config.API_REQUESTS_PER_SECOND, config.API_REQUESTS_BURST)
+        admission.init_admission(config.DOWNLOAD_MAX_RATE, config.DOWNLOAD_RATE_WINDOWS,
+                                 config.DOWNLOAD_MIN_FREE_SPACE)
+        if config.METRICS_FILE_PATH:
+            metrics.start_file_writer(config.METRICS_FILE_PATH, config.METRICS_WRITE_INTERVAL)
+        if config.METRICS_PORT:
+            metrics.start_http_server(config.METRICS_PORT)
+        api_quota = quota.ApiQuota(config.API_DAILY_QUOTA)
+        executor = None
+        if len(profiles) > 1:
+            executor = ThreadPoolExecutor(max_workers=config.DOWNLOAD_WORKERS, thread_name_prefix='downloader')
+        self.accounts = [AccountSync(profile, api_quota, executor) for profile in profiles]
+
+    def __log_progress(self):
+        for account in self.accounts:
+            self.logger.info(account.progress())
+
+    def __run_accounts(self, daemon):
+        """Runs the accounts by a thread each, logs their progress every config.ACCOUNTS_PROGRESS_INTERVAL."""
+        for account in self.accounts:
+            # Interactive authorization, if any, is done one account at a time before the threads start.
+            account.authentication.access_token
+        stop = Event()
+        threads = [Thread(target=account.run, args=(daemon, stop), name=f'account-{account.profile.name}',
+                          daemon=True) for account in self.accounts]
+        for thread in threads:
+            thread.start()
+        next_report = monotonic() + config.ACCOUNTS_PROGRESS_INTERVAL
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(max(next_report - monotonic(), 0))
+                if monotonic() >= next_report:
+                    self.__log_progress()
+                    next_report = monotonic() + config.ACCOUNTS_PROGRESS_INTERVAL
+        finally:
+            stop.set()
+
+    def __run_single(self, daemon):
+        account = self.accounts[0]
+        account.open()
+        try:
+            if daemon:
+                account.run_forever()
+            else:
+                account.sync()
+        finally:
+            account.close()
+
     def main(self):
         self.logger.info('Starting...')
         try:
-            self.metadata.get_metadata_list(self.authentication)
-            self.logger.info('Start downloading a list of media items.')
-            self.local_storage.download_media_items(self.authentication)
-            # For testing maybe=========>
-            # self.metadata.get_items_by_ids(
-            #    ('AOrhRz6_TXeXp9ZUH278oCwL0g7Df7UaEwjHdrpJ8hD2eJg7nB3TK6Sf5Wj011eG42c4c_xKlvDZOqAsZDHHd4QPGa1cgEsc4A',
-            #     'AOrhRz4w4HBXKfBvDswN9WDtbM-TwcieQj1l74Aj5tCK9sEN23QVoLiL_6iVOd7ARn2c5CW1S76yVLsjSd1sRtn7kpimctfr4w',
-            #     'AOrhRz7jJd4KI_XKFxm0-GiSh7CbarOElRjKOo2q_aFL2k5bjgnPxG8B6g1RNHRg7aPl0T3Awx9a-s7-1w6Nh9IeZE4Bikt0Zw'),
-            #    self.authentication
-            # )
-            # <================
-            if self.local_storage.is_actualization_needed():
-                self.logger.info("Start local DB and storage actualization.")
-                self.local_storage.remove_not_existing(self.authentication)
-                self.logger.info('Actualization is complete.')
+            if len(self.accounts) == 1:
+                self.__run_single(daemon=False)
+            else:
+                self.__run_accounts(daemon=False)
         except KeyboardInterrupt:
             self.logger.warning("Aborted by user.")
             raise
         except Exception as err:
             self.logger.exception(f'Something went wrong.\n{err}')
         finally:
-            self.db_conn.close()
+            self.__log_progress()
+            helpers.log_http_stats(self.logger)
         self.logger.info('Finished.')
+
+    def index(self):
+        self.logger.info('Indexing local storage...')
+        for account in self.accounts:
+            account.open()
+            try:
+                count = account.local_storage.index_local_storage()
+            finally:
+                account.close()
+            print(f'{account.profile.name}: {count} files indexed.')
+            self.logger.info(f'{account.profile.name}: {count} files indexed.')
+
+    def reconcile(self):
+        self.logger.info('Reconciling local storage with the DB...')
+        for account in self.accounts:
+            account.open()
+            try:
+                orphans = account.local_storage.reconcile()
+            finally:
+                account.close()
+            for path in orphans:
+                print(path)
+            print(f'{account.profile.name}: {len(orphans)} orphaned files, see the log for items reset for download.')
+
+    def run_daemon(self):
+        """Runs listing, download and actualization of the accounts as scheduler jobs until interrupted.
+
+        The DB connections, HTTP session and credentials are kept between runs.
+        """
+        self.logger.info('Starting daemon...')
+        try:
+            if len(self.accounts) == 1:
+                self.__run_single(daemon=True)
+            else:
+                self.__run_accounts(daemon=True)
+        except KeyboardInterrupt:
+            self.logger.warning("Aborted by user.")
+            raise
+        finally:
+            self.__log_progress()
+            helpers.log_http_stats(self.logger)
+            self.logger.info('Finished.')
@@ -0,0 +1,52 @@
+"""Account profiles, each account is synced with its own credentials, DB and media storage."""
+
+DEFAULT_NAME = 'default'
+
+
+class Profile:
+    __slots__ = ('name', 'access_token_file_path', 'db_file_path', 'path_to_images_storage',
+                 'path_to_videos_storage')
+
+    def __init__(self, name, access_token_file_path, db_file_path, path_to_images_storage, path_to_videos_storage):
+        self.name = name
+        self.access_token_file_path = access_token_file_path
+        self.db_file_path = db_file_path
+        self.path_to_images_storage = path_to_images_storage
+        self.path_to_videos_storage = path_to_videos_storage
+
+    @property
+    def storage_roots(self) -> tuple:
+        return self.path_to_images_storage, self.path_to_videos_storage
+
+
+def default_profile(config) -> Profile:
+    """Profile of the top level config keys, it is the only one unless config.ACCOUNTS is set."""
+    return Profile(DEFAULT_NAME, config.ACCESS_TOKEN_FILE_PATH, config.DB_FILE_PATH, config.PATH_TO_IMAGES_STORAGE,
+                   config.PATH_TO_VIDEOS_STORAGE)
+
+
+def load_profiles(config) -> list:
+    """Returns profiles of config.ACCOUNTS or the default profile if the list is empty.
+
+    An entry of config.ACCOUNTS is a dict with 'NAME' and the keys ACCESS_TOKEN_FILE_PATH, DB_FILE_PATH,
+    PATH_TO_IMAGES_STORAGE and PATH_TO_VIDEOS_STORAGE, all of them are required.
+    Accounts can not share a token, a DB or a storage folder, ValueError is raised then.
+    """
+    if not config.ACCOUNTS:
+        return [default_profile(config)]
+    profiles = []
+    for account in config.ACCOUNTS:
+        try:
+            profiles.append(Profile(account['NAME'], account['ACCESS_TOKEN_FILE_PATH'], account['DB_FILE_PATH'],
+                                    account['PATH_TO_IMAGES_STORAGE'], account['PATH_TO_VIDEOS_STORAGE']))
+        except KeyError as err:
+            raise ValueError(f'Account {account.get("NAME", len(profiles))} has no {err.args[0]} in config.')
+    for attribute in ('name', 'access_token_file_path', 'db_file_path', 'storage_roots'):
+        seen = {}
+        for profile in profiles:
+            values = getattr(profile, attribute)
+            for value in values if isinstance(values, tuple) else (values,):
+                other = seen.setdefault(value, profile.name)
+                if other != profile.name:
+                    raise ValueError(f'Accounts {other} and {profile.name} share {value}.')
+    return profiles
@@ -0,0 +1,141 @@
+"""Admission control of downloads: the bandwidth cap and the free space of the media storage.
+
+The limiter and the controller are process wide, they are shared by all download threads and accounts.
+"""
+import os
+import threading
+
+from app.tools import exceptions, metrics
+from datetime import datetime
+from time import monotonic, sleep
+
+PAUSE_CHECK_INTERVAL = 60  # Seconds between rate checks of a download while its window is paused
+
+
+def _minute_of_day(hh_mm) -> int:
+    hours, minutes = hh_mm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class BandwidthLimiter:
+    """Token bucket of downloaded bytes.
+
+    The rate is max_rate unless a time-of-day window sets another one, a rate of 0 pauses the downloads,
+    None means no limit.
+    """
+
+    def __init__(self, max_rate=None, windows=()):
+        """
+        :param max_rate: bytes per second
+        :param windows: (start 'HH:MM', end 'HH:MM', bytes per second) in local time, the first matching
+            window wins, a window ending before its start spans midnight
+        """
+        self.__max_rate = max_rate
+        self.__windows = [(_minute_of_day(start), _minute_of_day(end), rate) for start, end, rate in windows]
+        self.__tokens = 0
+        self.__updated = monotonic()
+        self.__lock = threading.Lock()
+
+    def rate(self):
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.__windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.__max_rate
+
+    def consume(self, amount):
+        """Accounts amount of received bytes, sleeps while the downloads are ahead of the rate."""
+        while True:
+            rate = self.rate()
+            if rate is None:
+                return
+            with self.__lock:
+                now = monotonic()
+                # The bucket holds one second worth of bytes.
+                self.__tokens = min(self.__tokens + (now - self.__updated) * rate, rate)
+                self.__updated = now
+                if rate:
+                    self.__tokens -= amount
+                    wait = -self.__tokens / rate if self.__tokens < 0 else 0
+            if rate:
+                if wait:
+                    sleep(wait)
+                return
+            sleep(PAUSE_CHECK_INTERVAL)
+
+
+class AdmissionController:
+    """Decides whether a download can start: its bandwidth window is open and the storage has room for it.
+
+    The expected size of an admitted download is reserved till it is released, so downloads running
+    at once are checked against the space left by each other.
+    """
+
+    def __init__(self, min_free_space=0):
+        """
+        :param min_free_space: bytes kept free on the file system of the storage
+        """
+        self.__min_free_space = min_free_space
+        self.__reserved = {}
+        self.__items = 0
+        self.__lock = threading.Lock()
+
+    def admit(self, folder, expected_size) -> tuple:
+        """Reserves expected_size bytes on the file system of the folder, returns the reservation for release().
+
+        Raises DownloadsPaused if the bandwidth window is paused or the space is low.
+        """
+        if bandwidth_limiter.rate() == 0:
+            metrics.DOWNLOAD_PAUSES.inc(reason='bandwidth_window')
+            raise exceptions.DownloadsPaused('The bandwidth window is paused.')
+        stat = os.statvfs(folder)
+        free = stat.f_bavail * stat.f_frsize
+        device = os.stat(folder).st_dev
+        with self.__lock:
+            reserved = self.__reserved.get(device, 0)
+            if free - reserved - expected_size < self.__min_free_space:
+                metrics.DOWNLOAD_PAUSES.inc(reason='disk_space')
+                raise exceptions.DownloadsPaused(f'{free / 2 ** 20:.0f} MiB free in {folder}, '
+                                                 f'{reserved / 2 ** 20:.0f} MiB reserved by {self.__items} downloads, '
+                                                 f'{expected_size / 2 ** 20:.0f} MiB more are needed.')
+            self.__reserved[device] = reserved + expected_size
+            self.__items += 1
+            self.__update_metrics()
+        return device, expected_size
+
+    def release(self, reservation):
+        device, size = reservation
+        with self.__lock:
+            self.__reserved[device] -= size
+            self.__items -= 1
+            self.__update_metrics()
+
+    def stats(self) -> tuple:
+        """Returns count and expected bytes of the downloads in flight."""
+        with self.__lock:
+            return self.__items, sum(self.__reserved.values())
+
+    def __update_metrics(self):
+        metrics.DOWNLOAD_ITEMS_IN_FLIGHT.set(self.__items)
+        metrics.DOWNLOAD_BYTES_IN_FLIGHT.set(sum(self.__reserved.values()))
+
+
+bandwidth_limiter = BandwidthLimiter()
+controller = AdmissionController()
+
+
+def init_admission(max_rate, windows, min_free_space):
+    """
+    :param max_rate: MiB per second of all downloads, None for no limit
+    :param windows: (start 'HH:MM', end 'HH:MM', MiB per second or None), see BandwidthLimiter
+    :param min_free_space: bytes kept free on the storage
+    """
+    global bandwidth_limiter, controller
+
+    def to_bytes(rate):
+        return None if rate is None else rate * 2 ** 20
+
+    bandwidth_limiter = BandwidthLimiter(to_bytes(max_rate),
+                                         [(start, end, to_bytes(rate)) for start, end, rate in windows])
+    controller = AdmissionController(min_free_space)
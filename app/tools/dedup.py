@@ -0,0 +1,102 @@
+import os
+import hashlib
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_BUFFER_SIZE = 8 * 2 ** 20
+PART_SUFFIX = '.part'
+
+
+def new_hash():
+    return hashlib.sha256()
+
+
+def hash_file(path, hasher=None) -> str:
+    """Returns hex digest of the file content, reads it by HASH_BUFFER_SIZE buffers.
+
+    Continues the given hasher if it is set, so it can be used to seed a hash of a resumed download.
+    """
+    hasher = hasher or new_hash()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
+def free_path(path) -> str:
+    """Returns path itself if it is not taken, otherwise the first free 'name_N.ext' next to it."""
+    if not os.path.lexists(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    number = 1
+    while os.path.lexists(f'{stem}_{number}{ext}'):
+        number += 1
+    return f'{stem}_{number}{ext}'
+
+
+def find_duplicate(db_conn, content_hash, size):
+    """Returns a path of an indexed file with the same content, None if there is no such file on disk."""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT path FROM content_index WHERE hash = ? AND size = ?", (content_hash, size))
+    for (path,) in cursor.fetchall():
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def add_to_index(db_conn, path, content_hash, size):
+    db_conn.execute("INSERT OR REPLACE INTO content_index (path, hash, size) VALUES (?, ?, ?)",
+                    (path, content_hash, size))
+
+
+def _iter_files(root):
+    for dir_path, dir_names, filenames in os.walk(root):
+        # Hidden folders, e.g. the previews, are not a part of the storage.
+        dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.') and filename.endswith(PART_SUFFIX):
+                continue
+            yield os.path.join(dir_path, filename)
+
+
+def _hash_entry(path):
+    return path, os.path.getsize(path), hash_file(path)
+
+
+def index_tree(db_conn, roots, workers=4, batch_size=500) -> int:
+    """Adds files under roots that are not indexed yet or changed in size to content_index.
+
+    Files are hashed by a pool of threads, hashlib releases the GIL on large buffers.
+    The index is written by the calling thread, returns count of indexed files.
+    """
+    logger = logging.getLogger('Content index')
+    indexed = dict(db_conn.execute("SELECT path, size FROM content_index").fetchall())
+    paths = []
+    for root in sorted(set(roots)):
+        for path in _iter_files(root):
+            try:
+                if indexed.get(path) != os.path.getsize(path):
+                    paths.append(path)
+            except OSError:
+                continue
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='indexer') as executor:
+        for start in range(0, len(paths), batch_size):
+            entries = []
+            for future in [executor.submit(_hash_entry, path) for path in paths[start:start + batch_size]]:
+                try:
+                    entries.append(future.result())
+                except OSError as err:
+                    logger.warning(f'Fail to hash file, {err}')
+            with db_conn:
+                db_conn.executemany("INSERT OR REPLACE INTO content_index (path, size, hash) VALUES (?, ?, ?)",
+                                    entries)
+            count += len(entries)
+            logger.info(f'{count} of {len(paths)} files indexed.')
+    return count
@@ -2,57 +2,62 @@ import logging
 
 
 class MyGPhotoException(Exception):
+    """Base exception of the app, it is not logged when raised.
+
+    The handler decides whether the failure is worth a log record and calls log(),
+    so expected control flow does not produce a log line per raise.
+    """
+    level = logging.ERROR
+
     def __init__(self, *args):
-        self.logger = logging.getLogger(self.__class__.__name__)
+        super().__init__(*args)
         if args:
             self.message = args[0]
         else:
             self.message = f'{self.__class__.__name__} has been raised.'
 
-
-class ObjAlreadyExists(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.info(self.message)
+    def log(self, logger=None):
+        """Logs the message at the level of the exception class, to the class logger by default."""
+        if logger is None:
+            logger = logging.getLogger(self.__class__.__name__)
+        logger.log(self.level, '%s', self.message, exc_info=self.level >= logging.ERROR)
 
 
 class SessionNotAuth(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.error(self.message)
+    level = logging.ERROR
 
 
 class DownloadError(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.warning(self.message)
+    level = logging.WARNING
 
 
 class NoItemsInResp(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.info(self.message)
+    level = logging.INFO
 
 
 class NoNextPageTokenInResp(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.warning(self.message)
+    level = logging.WARNING
 
 
 class FailGettingPage(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.exception(self.message)
+    level = logging.ERROR
 
 
 class VideoNotReady(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.warning(self.message)
+    level = logging.WARNING
 
 
 class AuthUnsuccessful(MyGPhotoException):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.logger.exception(self.message)
+    level = logging.ERROR
+
+
+class InvalidArgument(MyGPhotoException):
+    level = logging.WARNING
+
+
+class QuotaExceeded(MyGPhotoException):
+    level = logging.WARNING
+
+
+class DownloadsPaused(MyGPhotoException):
+    level = logging.WARNING
@@ -1,14 +1,57 @@
+import atexit
+import os
 import sqlite3
 import requests
 import logging
+import threading
 
-from app.tools import exceptions
+from app.tools import exceptions, metrics
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from requests.adapters import HTTPAdapter
+from time import sleep
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_MAX_DELAY = 120  # Seconds, limit of the backoff of API calls
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(funcName)s: %(message)s'
 
-def db_connect(db_file_path) -> sqlite3.Connection:
+_session = None
+_api_session = None
+_session_lock = threading.Lock()
+_timeout = None
+_retries = 0
+_backoff_factor = 0.0
+
+
+def init_logging(log_file_path, level=logging.INFO) -> QueueListener:
+    """Routes log records of all threads through a queue to the log file.
+
+    The file is written by the listener thread, so a slow disk does not stall the sync threads.
+    The listener is stopped at exit, flushing the queued records.
+    """
+    handler = logging.FileHandler(log_file_path, mode='a')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = Queue()
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def db_connect(db_file_path, factory=sqlite3.Connection) -> sqlite3.Connection:
     db_logger = logging.getLogger('DB connection')
     try:
-        db_conn = sqlite3.connect(db_file_path)
+        db_conn = sqlite3.connect(db_file_path, timeout=30, factory=factory)
+        # WAL lets readers work while the downloader commits, NORMAL sync is safe with WAL.
+        db_conn.execute('PRAGMA journal_mode = WAL')
+        db_conn.execute('PRAGMA synchronous = NORMAL')
+        db_conn.execute('PRAGMA temp_store = MEMORY')
+        db_conn.execute('PRAGMA cache_size = -65536')
     except Exception as err:
         message = f'Fail to connect to DB {db_file_path}.\n{err}'
         print(message)
@@ -17,21 +60,130 @@ def db_connect(db_file_path) -> sqlite3.Connection:
     return db_conn
 
 
-def db_conn_pool(db_file_path, count=1) -> list:
-    db_conn = []
-    for _ in range(count):
-        db_conn += db_connect(db_file_path)
-    return db_conn
+def db_migrate(db_conn, migrations_path):
+    """Applies SQL migrations named '<version>_<description>.sql' that are newer than the DB user_version.
 
+    Each migration is applied in its own transaction along with the new user_version.
+    """
+    db_logger = logging.getLogger('DB connection')
+    current_version = db_conn.execute('PRAGMA user_version').fetchone()[0]
+    migrations = sorted((int(name.split('_', 1)[0]), name) for name in os.listdir(migrations_path)
+                        if name.endswith('.sql') and name.split('_', 1)[0].isdigit())
+    for version, name in migrations:
+        if version <= current_version:
+            continue
+        with open(os.path.join(migrations_path, name)) as migration:
+            script = migration.read()
+        try:
+            db_conn.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;')
+        except sqlite3.Error as err:
+            db_conn.rollback()
+            db_logger.error(f'Fail to apply migration {name}.\n{err}')
+            raise
+        db_logger.info(f'Migration {name} applied.')
 
-def make_request_w_auth(access_token, url, params=None):
+
+def _new_session(pool_size, retry) -> requests.Session:
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def init_http_session(pool_size=10, retries=5, backoff_factor=1.0, timeout=60) -> requests.Session:
+    """Creates the process wide HTTP sessions, returns the one of media downloads and token refreshes.
+
+    Connections are kept alive and pooled per host, requests failed with 429/5xx or a connection
+    error are retried with exponential backoff, Retry-After header is respected.
+    API calls use a session of their own that retries failed connections only, their 429/5xx are
+    retried by make_api_request, so the quota counts each attempt the server counts.
+    """
+    global _session, _api_session, _timeout, _retries, _backoff_factor
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=('GET',), respect_retry_after_header=True, raise_on_status=False)
+    # A request that was sent may be counted by the server, so read errors are not retried.
+    api_retry = Retry(total=retries, read=0, status=0, backoff_factor=backoff_factor, allowed_methods=('GET',),
+                      raise_on_status=False)
+    session = _new_session(pool_size, retry)
+    api_session = _new_session(pool_size, api_retry)
+    with _session_lock:
+        for old_session in (_session, _api_session):
+            if old_session:
+                old_session.close()
+        _session, _api_session = session, api_session
+        _timeout = timeout
+        _retries, _backoff_factor = retries, backoff_factor
+    return session
+
+
+def http_session() -> requests.Session:
+    """Returns the shared HTTP session, creates it with default settings if it was not initialized."""
+    with _session_lock:
+        session = _session
+    return session or init_http_session()
+
+
+def api_session() -> requests.Session:
+    """Returns the shared session of API calls, see init_http_session()."""
+    with _session_lock:
+        session = _api_session
+    if session is None:
+        init_http_session()
+        return api_session()
+    return session
+
+
+def http_timeout():
+    return _timeout
+
+
+def log_http_stats(logger):
+    """Logs count of requests and opened connections per host of the shared sessions."""
+    for session in (http_session(), api_session()):
+        for prefix in ('https://', 'http://'):
+            pools = session.get_adapter(prefix).poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None or key.key_scheme != prefix[:-3]:
+                    continue
+                logger.info(f'{key.key_host}: {pool.num_requests} requests over {pool.num_connections} connections.')
+
+
+def _endpoint_name(url) -> str:
+    """Metrics label of the API url: 'mediaItems', 'mediaItems:batchGet' or 'mediaItems/{id}'."""
+    parent, _, name = urlparse(url).path.rpartition('/')
+    return name if name.startswith('mediaItems') else parent.rpartition('/')[2] + '/{id}'
+
+
+def _api_get(access_token, url, params=None) -> requests.Response:
     headers = {'Accept': 'application/json',
                'Authorization': 'Bearer ' + access_token}
-    response = requests.get(url, headers=headers, params=params)
+    endpoint = _endpoint_name(url)
+    with metrics.API_LATENCY.time(endpoint=endpoint):
+        response = api_session().get(url, headers=headers, params=params, timeout=http_timeout())
+    metrics.API_REQUESTS.inc(endpoint=endpoint, code=response.status_code)
+    return response
+
+
+def _retry_delay(response, attempt) -> float:
+    """Seconds before the next attempt, Retry-After of the response if it is given in seconds."""
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(int(retry_after), RETRY_MAX_DELAY)
+    return min(_backoff_factor * 2 ** attempt, RETRY_MAX_DELAY)
+
+
+def _parse_api_response(response):
     if response.status_code == 401:
         raise exceptions.SessionNotAuth('Session unauthorized.')
     elif response.status_code == 404:
         raise FileNotFoundError()
+    elif response.status_code == 400 and 'INVALID_ARGUMENT' in response.text:
+        raise exceptions.InvalidArgument(f'Request is rejected. Response: {response.text}')
+    elif response.status_code == 429 or (response.status_code != 200 and 'RESOURCE_EXHAUSTED' in response.text):
+        # Still refused after the retries, it is the quota of the project, not a burst.
+        raise exceptions.QuotaExceeded(f'API quota is exhausted on the server. Response: {response.text}')
     elif response.status_code != 200:
         raise exceptions.MyGPhotoException(f'Response code: {response.status_code}. Response: {response.text}')
     try:
@@ -40,3 +192,54 @@ def make_request_w_auth(access_token, url, params=None):
         logging.exception('Response does not contain a json.')
         raise
     return representation
+
+
+def make_request_w_auth(access_token, url, params=None):
+    """Makes one attempt of the API call, returns the representation of the response."""
+    return _parse_api_response(_api_get(access_token, url, params))
+
+
+def make_api_request(auth, url, params=None, priority=0):
+    """Makes the request with the token of auth, on 401 refreshes the token once and retries.
+
+    Requests failed with 429/5xx are retried with exponential backoff, Retry-After header is respected.
+    Each attempt is counted by auth.quota with the given priority, see app.tools.quota.
+    Concurrent workers that got 401 for the same token share one refresh.
+    """
+    access_token = auth.access_token
+    refreshed = False
+    attempt = 0
+    while True:
+        auth.quota.acquire(priority)
+        response = _api_get(access_token, url, params)
+        if response.status_code == 401 and not refreshed:
+            auth.refresh(access_token)
+            access_token = auth.access_token
+            refreshed = True
+        elif response.status_code in RETRY_STATUSES and attempt < _retries:
+            sleep(_retry_delay(response, attempt))
+            attempt += 1
+        else:
+            return _parse_api_response(response)
+
+
+class ThroughputStats:
+    """Collects per-worker download counters, safe to update from worker threads."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__workers = {}
+
+    def record(self, worker, items, size, seconds):
+        with self.__lock:
+            counters = self.__workers.setdefault(worker, [0, 0, 0.0])
+            counters[0] += items
+            counters[1] += size
+            counters[2] += seconds
+
+    def log_summary(self, logger):
+        with self.__lock:
+            workers = sorted(self.__workers.items())
+        for worker, (items, size, seconds) in workers:
+            speed = size / seconds / 2 ** 20 if seconds else 0
+            logger.info(f'{worker}: {items} items, {size / 2 ** 20:.1f} MiB in {seconds:.1f} s, {speed:.2f} MiB/s.')
@@ -1,60 +1,69 @@
 import os
 import logging
-import sqlite3
 import requests
 
+from app.tools import admission
+from app.tools import dedup
 from app.tools import helpers
+from app.tools import metrics
+from app.tools import storage
 from app.tools import exceptions
-from datetime import datetime
 
 
 SRV_ENDPOINT = 'https://photoslibrary.googleapis.com/v1/'
+BATCH_GET_LIMIT = 50  # Max count of mediaItemIds per mediaItems:batchGet request
+STATUS_NOT_FOUND = 5  # google.rpc.Code of a missing item in mediaItems:batchGet results
+DEFAULT_CHUNK_SIZE = 2 ** 20
+RESUME_ATTEMPTS = 3  # Range requests per download before it is left to the next run
 
 
 class Item:
-    def __init__(self, item_id, mime_type, filename, creation_time, db_conn, path_to_videos_storage,
-                 path_to_images_storage):
+    """Media item being downloaded or checked, built from a my_media row or a batchGet result.
+
+    The media class and the target path come precomputed from the DB, see storage.PathResolver.
+    The reduced-size preview is downloaded instead of the original if preview_size is set.
+    """
+    __slots__ = ('id', 'media_class', 'filename', 'target_path', 'local_path', 'preview_path', 'preview_size',
+                 'base_url', 'video_status', 'path_to_part', 'content_hash', 'size')
+    # Items are created per media item, they share one logger.
+    __logger = logging.getLogger('Item')
+
+    def __init__(self, item_id, media_class, filename, target_path, local_path=None, preview_path=None):
+        """
+        :param preview_path: path of the stored preview, if any
+        """
         self.id = item_id
-        self.base_url = None
-        self.image_storage = path_to_images_storage
-        self.video_storage = path_to_videos_storage
-        self.mime_type = mime_type
+        self.media_class = media_class
         self.filename = filename
-        self.creation_time = creation_time
-        creation_year: int = datetime.strptime(self.creation_time, "%Y-%m-%dT%H:%M:%SZ").year
-        self.sub_folder_name = str(creation_year) + '/'
-        self.__logger = logging.getLogger(self.__class__.__name__)
-        self.__db_conn = db_conn
+        self.target_path = target_path
+        self.local_path = local_path
+        self.preview_path = preview_path
+        self.preview_size = None
+        self.base_url = None
         self.video_status = None
+        self.path_to_part = None
+        self.content_hash = None
+        self.size = None
 
-    def write_to_db(self):
-        cursor = self.__db_conn.cursor()
-        values = (self.id, self.filename, self.mime_type, self.creation_time)
-        try:
-            cursor.execute('INSERT INTO my_media (object_id, filename, media_type, creation_time) '
-                           'VALUES (?, ?, ?, ?)', values)
-            self.__db_conn.commit()
-        except sqlite3.IntegrityError:
-            raise exceptions.ObjAlreadyExists(f'Media item {self.filename} already in the DB.')
-        except sqlite3.Error as err:
-            self.__logger.error(f'Fail to write {self.filename} metadata into the DB.\n{err}')
-
-    def remove_from_db(self):
-        cursor = self.__db_conn.cursor()
-        try:
-            cursor.execute("DELETE FROM my_media WHERE object_id=?", (self.id,))
-            self.__db_conn.commit()
-        except sqlite3.Error as err:
-            self.__logger.error(f'Fail to remove {self.filename} from the DB.\n{err}')
+    @property
+    def path(self) -> str:
+        """Path of the stored media file, it is the target path unless the file was stored under another name."""
+        return self.local_path or self.target_path
 
-    def get_base_url(self, auth):
-        url = SRV_ENDPOINT + 'mediaItems/' + self.id
-        try:
-            representation = helpers.make_request_w_auth(auth.access_token, url)
-        except FileNotFoundError:
-            self.__logger.warning(f'Item {self.id} not found on the server.')
-            raise
-        if 'video' in self.mime_type:
+    @property
+    def is_video(self) -> bool:
+        return self.media_class == storage.VIDEO
+
+    @property
+    def download_path(self) -> str:
+        """Path the download is stored at, the preview one if preview_size is set."""
+        if self.preview_size:
+            return storage.preview_path(self.media_class, self.target_path)
+        return self.target_path
+
+    def set_base_url(self, representation: dict):
+        """Takes baseUrl and video status from the mediaItem representation got by batchGet."""
+        if self.is_video:
             try:
                 self.video_status = representation['mediaMetadata']['video']['status']
             except KeyError:
@@ -68,57 +77,97 @@ class Item:
             self.__logger.error(f'Response does not contain baseUrl. Response: {representation}')
             raise
 
-    def download(self):
-        cursor = self.__db_conn.cursor()
-        if 'image' in self.mime_type:
-            url_suffix = '=d'
-            path_to_object = self.image_storage + self.sub_folder_name + self.filename
-        elif 'video' in self.mime_type:
-            url_suffix = '=dv'
-            path_to_object = self.video_storage + self.sub_folder_name + self.filename
+    def download(self, chunk_size=DEFAULT_CHUNK_SIZE) -> int:
+        """Streams the media file into a hidden .part file next to download_path, returns count of bytes received.
+
+        The download is resumed by HTTP Range requests if the connection drops or the previous run
+        was interrupted. Content hash is computed while the chunks are written. On success the
+        part is left in path_to_part with content_hash set, storing it is up to the caller.
+        Does not touch the DB, so it is safe to call it from a download worker thread.
+        """
+        if self.preview_size:
+            url_suffix = '=w{}-h{}'.format(*self.preview_size)
         else:
-            raise Exception('Unexpected mime type.')
-        response = requests.get(self.base_url + url_suffix, params=None, headers=None, stream=True)
-        if 'text/html' in response.headers['Content-Type']:
-            raise exceptions.DownloadError(f"Fail to download {self.filename}. "
-                                           f"Server returns: {response.text}, http code {response.status_code}")
-        elif 'image' in response.headers['Content-Type'] or 'video' in response.headers['Content-Type']:
-            if os.path.exists(path_to_object):
-                self.__logger.warning(f"File {self.filename} already exist in local storage! Setting 'stored = 2' "
-                                      f"in database.")
-                cursor.execute("UPDATE my_media SET stored='2' WHERE object_id=?", (self.id,))
-                self.__db_conn.commit()
-                raise FileExistsError()
+            url_suffix = '=dv' if self.is_video else '=d'
+        self.path_to_part = os.path.join(os.path.dirname(self.download_path), '.' + self.id + dedup.PART_SUFFIX)
+        received = 0
+        hasher = None
+        for attempt in range(1, RESUME_ATTEMPTS + 1):
+            try:
+                part_received, hasher = self.__download_part(self.base_url + url_suffix, self.path_to_part,
+                                                             chunk_size, hasher)
+                received += part_received
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as err:
+                self.__logger.warning('Download of %s interrupted, attempt %d.\n%s', self.filename, attempt, err)
+                hasher = None
+                if attempt == RESUME_ATTEMPTS:
+                    raise exceptions.DownloadError(f"Fail to download {self.filename}, will be resumed next time.")
+        self.content_hash = hasher.hexdigest()
+        self.__logger.debug('Media file %s downloaded.', self.filename)
+        return received
+
+    def __download_part(self, url, path_to_part, chunk_size, hasher) -> tuple:
+        """Downloads the file into path_to_part continuing from its current size.
+
+        Returns count of bytes received and the hasher updated with the whole part content.
+        """
+        offset = os.path.getsize(path_to_part) if os.path.exists(path_to_part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        received = 0
+        with helpers.http_session().get(url, headers=headers, stream=True,
+                                        timeout=helpers.http_timeout()) as response:
+            content_type = response.headers.get('Content-Type', '')
+            if response.status_code == 416:
+                total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                if total.isdigit() and int(total) == offset:
+                    # The part was completed by a run interrupted before storing it.
+                    self.__logger.info('%s is already downloaded, %d bytes.', self.filename, offset)
+                    self.size = offset
+                    if hasher is None:
+                        hasher = dedup.new_hash()
+                        dedup.hash_file(path_to_part, hasher)
+                    return 0, hasher
+                # The file changed on the server, starting over.
+                os.remove(path_to_part)
+                return self.__download_part(url, path_to_part, chunk_size, None)
+            if response.status_code not in (200, 206) or 'text/html' in content_type:
+                raise exceptions.DownloadError(f"Fail to download {self.filename}. "
+                                               f"Server returns: {response.text}, http code {response.status_code}")
+            elif 'image' not in content_type and 'video' not in content_type:
+                raise exceptions.DownloadError(f"Fail to download {self.filename}. "
+                                               f"Unexpected content type {content_type}")
+            if response.status_code == 206:
+                self.__logger.info('Resuming %s from %d bytes.', self.filename, offset)
+                if hasher is None:
+                    hasher = dedup.new_hash()
+                    dedup.hash_file(path_to_part, hasher)
+            else:
+                hasher = dedup.new_hash()
+            expected = response.headers.get('Content-Length')
+            if response.status_code == 206 and '/' in response.headers.get('Content-Range', ''):
+                total = response.headers['Content-Range'].rsplit('/', 1)[1]
+                self.size = int(total) if total.isdigit() else None
+            elif expected is not None:
+                self.size = int(expected)
             try:
-                with open(path_to_object, 'wb') as media_file:
-                    for chunk in response.iter_content(chunk_size=8192):
+                with open(path_to_part, 'ab' if response.status_code == 206 else 'wb') as media_file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
                         media_file.write(chunk)
+                        hasher.update(chunk)
+                        received += len(chunk)
+                        admission.bandwidth_limiter.consume(len(chunk))
             except OSError as err:
                 self.__logger.warning(f"Fail to download {self.filename}.\n{err}")
                 raise
-        else:
-            raise Exception(f"Unexpected content type {response.headers['Content-Type']}")
-        self.__logger.info(f"Media file {self.filename} stored.")
-        cursor.execute("UPDATE my_media SET stored='1' WHERE object_id=?", (self.id,))
-        self.__db_conn.commit()
+            finally:
+                metrics.DOWNLOAD_BYTES.inc(received, media=self.media_class)
+        if expected is not None and received != int(expected):
+            raise requests.exceptions.ChunkedEncodingError(f'Got {received} of {expected} bytes.')
+        return received, hasher
 
     def remove_from_local(self):
-        if 'video' in self.mime_type:
-            path_to_file = self.video_storage + self.sub_folder_name + self.filename
-        elif 'image' in self.mime_type:
-            path_to_file = self.image_storage + self.sub_folder_name + self.filename
-        else:
-            raise Exception('Unexpected error.')
         try:
-            os.remove(path_to_file)
+            os.remove(self.path)
         except OSError as err:
             self.__logger.error(f"Fail to remove {self.filename}, {err}")
-
-    def is_exist_on_server(self, auth) -> bool:
-        url = SRV_ENDPOINT + 'mediaItems/' + self.id
-        try:
-            helpers.make_request_w_auth(auth.access_token, url)
-        except FileNotFoundError:
-            self.__logger.warning(f"Item {self.id} not found on the server.")
-            return False
-        return True
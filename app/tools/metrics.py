@@ -0,0 +1,182 @@
+"""Process wide counters and histograms exposed in Prometheus text format.
+
+Metrics are updated from any thread, they are rendered to a file periodically and/or served over HTTP.
+"""
+import os
+import logging
+import threading
+
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from time import monotonic, sleep
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _labels(self, key, extra=()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list:
+        lines = super().render()
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f'{self.name}{self._labels(key)} {value}' for key, value in values)
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, sum, count.
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started, **labels)
+
+    def render(self) -> list:
+        lines = super().render()
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self._labels(key, (("le", bound),))} {count}')
+            lines.append(f'{self.name}_bucket{self._labels(key, (("le", "+Inf"),))} {counts[-1]}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {counts[-2]:.6f}')
+            lines.append(f'{self.name}_count{self._labels(key)} {counts[-1]}')
+        return lines
+
+
+REGISTRY = []
+
+API_REQUESTS = Counter('mygphoto_api_requests_total', 'Google Photos API requests.', ('endpoint', 'code'))
+API_LATENCY = Histogram('mygphoto_api_request_seconds', 'Google Photos API request latency.', ('endpoint',))
+PHASE_SECONDS = Histogram('mygphoto_phase_seconds', 'Duration of listing, download and actualization runs.',
+                          ('phase',), buckets=(1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600))
+LISTING_PAGES = Counter('mygphoto_listing_pages_total', 'Listed mediaItems pages.')
+LISTING_ITEMS = Counter('mygphoto_listing_items_total', 'Listed media items.', ('new',))
+BASE_URLS = Counter('mygphoto_base_urls_total', 'Base URL resolutions by result.', ('result',))
+BASE_URL_SECONDS = Histogram('mygphoto_base_url_batch_seconds', 'Base URL resolution time per batchGet.')
+DOWNLOAD_BYTES = Counter('mygphoto_download_bytes_total', 'Downloaded media bytes.', ('media',))
+DOWNLOAD_ITEMS = Counter('mygphoto_download_items_total', 'Download attempts by result.', ('result',))
+DOWNLOAD_SECONDS = Histogram('mygphoto_download_seconds', 'Time to download one media file.', ('media',))
+DOWNLOAD_ITEMS_IN_FLIGHT = Gauge('mygphoto_download_items_in_flight', 'Admitted downloads in progress.')
+DOWNLOAD_BYTES_IN_FLIGHT = Gauge('mygphoto_download_bytes_in_flight',
+                                 'Expected bytes of the admitted downloads in progress.')
+DOWNLOAD_PAUSES = Counter('mygphoto_download_pauses_total', 'Downloads refused by admission control.', ('reason',))
+DB_SECONDS = Histogram('mygphoto_db_commit_seconds', 'Time of DB write transactions.', ('operation',))
+ACCOUNT_ITEMS = Counter('mygphoto_account_items_total', 'Items per account by result.', ('account', 'result'))
+ACCOUNT_BYTES = Counter('mygphoto_account_download_bytes_total', 'Downloaded bytes per account.', ('account',))
+ACTUALIZATION_ITEMS = Counter('mygphoto_actualization_items_total', 'Checked items by result.', ('result',))
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def write_file(path):
+    """Writes all metrics to path atomically, e.g. for the node exporter textfile collector."""
+    path_to_tmp = path + '.tmp'
+    with open(path_to_tmp, 'w') as file:
+        file.write(render())
+    os.replace(path_to_tmp, path)
+
+
+def start_file_writer(path, interval=15):
+    def write_forever():
+        while True:
+            try:
+                write_file(path)
+            except OSError as err:
+                logging.getLogger('Metrics').warning(f'Fail to write metrics to {path}, {err}')
+            sleep(interval)
+    threading.Thread(target=write_forever, name='metrics-writer', daemon=True).start()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, host='127.0.0.1') -> HTTPServer:
+    """Serves the metrics at http://host:port/metrics from a daemon thread."""
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,106 @@
+import logging
+import threading
+
+from app.tools import exceptions
+from datetime import datetime
+from time import monotonic, sleep
+
+# Priorities of API calls, when the daily quota runs low the less important calls are refused first.
+PRIORITY_DOWNLOAD = 0
+PRIORITY_LISTING = 1
+PRIORITY_ACTUALIZATION = 2
+# Share of the daily quota available for each priority.
+QUOTA_SHARES = {PRIORITY_DOWNLOAD: 1.0, PRIORITY_LISTING: 0.9, PRIORITY_ACTUALIZATION: 0.7}
+SAVE_EVERY = 100  # Requests counted between the saves of checkpoint()
+
+
+class RateLimiter:
+    """Token bucket shared by all threads making API calls."""
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: requests per second
+        :param burst: max count of requests made at once after an idle period
+        """
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = burst
+        self.__updated = monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(self.__tokens + (now - self.__updated) * self.__rate, self.__burst)
+            self.__updated = now
+            self.__tokens -= 1
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+rate_limiter = RateLimiter(rate=10, burst=10)
+
+
+def init_rate_limiter(rate, burst):
+    global rate_limiter
+    rate_limiter = RateLimiter(rate, burst)
+
+
+class ApiQuota:
+    """Counts API requests per day, the counter is persisted in account_info.
+
+    The day is counted in UTC, the counter is reset on the first request of a new day.
+    """
+
+    def __init__(self, daily_limit):
+        self.__daily_limit = daily_limit
+        self.__day = datetime.utcnow().strftime('%Y-%m-%d')
+        self.__used = 0
+        self.__saved = {}
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger(self.__class__.__name__)
+
+    def acquire(self, priority=PRIORITY_DOWNLOAD):
+        """Counts the request, waits for the rate limiter, raises QuotaExceeded if the share of the priority is used."""
+        with self.__lock:
+            today = datetime.utcnow().strftime('%Y-%m-%d')
+            if today != self.__day:
+                self.__day, self.__used = today, 0
+            if self.__used >= self.__daily_limit * QUOTA_SHARES[priority]:
+                raise exceptions.QuotaExceeded(f'API quota for priority {priority} is used: '
+                                               f'{self.__used} of {self.__daily_limit} requests today.')
+            self.__used += 1
+        rate_limiter.acquire()
+
+    def load(self, db_conn):
+        cursor = db_conn.cursor()
+        cursor.execute("SELECT key, value FROM account_info WHERE key IN ('api_quota_day', 'api_quota_used')")
+        values = dict(cursor.fetchall())
+        with self.__lock:
+            if values.get('api_quota_day') == self.__day:
+                self.__used = max(self.__used, int(values.get('api_quota_used', 0)))
+
+    def save(self, db_conn):
+        day, used = self.__write(db_conn)
+        self.__logger.info(f'API usage: {used} of {self.__daily_limit} requests on {day}.')
+
+    def checkpoint(self, db_conn):
+        """Saves the counter if SAVE_EVERY requests were counted since it was saved to db_conn.
+
+        It is called per page or batch, so a crash in the middle of a phase loses few requests of the day.
+        """
+        with self.__lock:
+            due = abs(self.__used - self.__saved.get(id(db_conn), 0)) >= SAVE_EVERY
+        if due:
+            self.__write(db_conn)
+
+    def __write(self, db_conn) -> tuple:
+        with self.__lock:
+            day, used = self.__day, self.__used
+        with db_conn:
+            db_conn.executemany("INSERT OR REPLACE INTO account_info (key, value) VALUES (?, ?)",
+                                (('api_quota_day', day), ('api_quota_used', str(used))))
+        with self.__lock:
+            self.__saved[id(db_conn)] = used
+        return day, used
@@ -0,0 +1,71 @@
+import logging
+
+from threading import Event
+from time import monotonic
+
+
+class Job:
+    def __init__(self, name, func, interval, max_interval):
+        """
+        :param func: callable without arguments, returns True if more work is pending
+        :param interval: seconds between runs of an idle job
+        :param max_interval: limit of the interval growth while the job stays idle
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.max_interval = max_interval
+        self.delay = interval
+        self.next_run = monotonic()
+
+
+class Scheduler:
+    """Runs jobs in-process, each with its own interval.
+
+    A job that reports pending work is run again right away, an idle job is backed off by doubling
+    its interval up to max_interval. The interval is reset once the job does some work or is woken up.
+    """
+
+    def __init__(self):
+        self.__jobs = []
+        self.__logger = logging.getLogger(self.__class__.__name__)
+
+    def add_job(self, name, func, interval, max_interval=None):
+        self.__jobs.append(Job(name, func, interval, max_interval or interval))
+
+    def wake(self, name):
+        """Makes the job due immediately, e.g. the downloader after new items were listed."""
+        for job in self.__jobs:
+            if job.name == name:
+                job.delay = job.interval
+                job.next_run = monotonic()
+
+    def __run(self, job):
+        self.__logger.info(f'Job {job.name} started.')
+        try:
+            pending = job.func()
+        except KeyboardInterrupt:
+            raise
+        except Exception as err:
+            self.__logger.exception(f'Job {job.name} failed.\n{err}')
+            pending = False
+        if pending:
+            job.delay = job.interval
+            job.next_run = monotonic()
+        else:
+            job.next_run = monotonic() + job.delay
+            job.delay = min(job.delay * 2, job.max_interval)
+        self.__logger.info(f'Job {job.name} finished, next run in {max(job.next_run - monotonic(), 0):.0f} s.')
+
+    def run_pending(self) -> float:
+        """Runs due jobs in the order they were added, returns seconds until the next job is due."""
+        for job in self.__jobs:
+            if job.next_run <= monotonic():
+                self.__run(job)
+        return max(min(job.next_run for job in self.__jobs) - monotonic(), 0)
+
+    def run_forever(self, stop=None):
+        """Runs the jobs until stop is set, forever if it is not given."""
+        stop = stop or Event()
+        while not stop.wait(self.run_pending()):
+            pass
@@ -0,0 +1,102 @@
+import os
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE = 'image'
+VIDEO = 'video'
+PREVIEWS_FOLDER = '.previews'  # Hidden, so storage scans and the content index skip it
+
+
+def media_class(mime_type) -> str:
+    """Returns IMAGE or VIDEO for the mime type, None for an unexpected one."""
+    if 'image' in mime_type:
+        return IMAGE
+    if 'video' in mime_type:
+        return VIDEO
+    return None
+
+
+def preview_path(item_class, target_path) -> str:
+    """Path of the reduced-size preview, it mirrors the target path in PREVIEWS_FOLDER of the storage root.
+
+    A video preview is a still frame, it gets a .jpg suffix.
+    """
+    year_folder, filename = os.path.split(target_path)
+    root, year = os.path.split(year_folder)
+    path = os.path.join(root, PREVIEWS_FOLDER, year, filename)
+    return path + '.jpg' if item_class == VIDEO else path
+
+
+class PathResolver:
+    """Builds target paths of media files in the local storage: root of the class + creation year + filename.
+
+    Paths are computed once, when the item is listed, and kept in my_media.target_path.
+    """
+    __slots__ = ('__roots',)
+
+    def __init__(self, path_to_images_storage, path_to_videos_storage):
+        self.__roots = {IMAGE: path_to_images_storage, VIDEO: path_to_videos_storage}
+
+    def target_path(self, item_class, creation_time, filename) -> str:
+        root = self.__roots.get(item_class)
+        if root is None:
+            return None
+        return root + creation_time[:4] + '/' + filename
+
+    def backfill(self, db_conn) -> int:
+        """Fills target paths missing in my_media, all of them are rebuilt if the storage roots have changed.
+
+        Returns count of updated rows.
+        """
+        roots = '\n'.join((self.__roots[IMAGE], self.__roots[VIDEO]))
+        cursor = db_conn.cursor()
+        cursor.execute("SELECT value FROM account_info WHERE key = 'storage_roots'")
+        row = cursor.fetchone()
+        condition = '' if row and row[0] != roots else 'WHERE target_path IS NULL AND media_class IS NOT NULL'
+        with db_conn:
+            cursor.execute("UPDATE my_media SET target_path = CASE media_class WHEN :image THEN :images "
+                           "WHEN :video THEN :videos END || substr(creation_time, 1, 4) || '/' || filename "
+                           + condition,
+                           {'image': IMAGE, 'video': VIDEO,
+                            'images': self.__roots[IMAGE], 'videos': self.__roots[VIDEO]})
+            updated = cursor.rowcount
+            cursor.execute("INSERT OR REPLACE INTO account_info (key, value) VALUES ('storage_roots', ?)", (roots,))
+        if updated:
+            logging.getLogger('Storage paths').info(f'{updated} target paths updated.')
+        return updated
+
+
+def _scan_dir(path) -> tuple:
+    """Returns files and sub folders of the folder, hidden entries (e.g. download parts) are skipped."""
+    files, folders = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return files, folders
+
+
+def scan_tree(roots, workers=4) -> list:
+    """Returns paths of all files under roots, folders are listed by a pool of threads.
+
+    Paths are built as root + relative path, the same way PathResolver builds them.
+    """
+    logger = logging.getLogger('Storage scan')
+    files = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scanner') as executor:
+        pending = [executor.submit(_scan_dir, root) for root in sorted(set(roots))]
+        while pending:
+            future = pending.pop()
+            try:
+                found, folders = future.result()
+            except OSError as err:
+                logger.warning(f'Fail to scan folder, {err}')
+                continue
+            files.extend(found)
+            pending.extend(executor.submit(_scan_dir, folder) for folder in folders)
+    return files
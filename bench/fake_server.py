@@ -0,0 +1,189 @@
+import json
+import random
+import re
+import threading
+
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+MAX_PAGE_SIZE = 100
+BATCH_GET_LIMIT = 50
+PREVIEW_SUFFIX = re.compile(r'w(\d+)-h(\d+)')
+
+
+class Library:
+    """Generated media library served by FakeGooglePhotos."""
+
+    def __init__(self, size, video_share=0.1, image_size=256 * 2 ** 10, video_size=4 * 2 ** 20, seed=0):
+        rnd = random.Random(seed)
+        self.items = []
+        for number in range(size):
+            video = rnd.random() < video_share
+            year = 2010 + number * 15 // max(size, 1)
+            self.items.append({
+                'id': f'FAKE{number:09d}',
+                'mimeType': 'video/mp4' if video else 'image/jpeg',
+                'filename': f'VID_{number:06d}.MP4' if video else f'IMG_{number:06d}.JPG',
+                'mediaMetadata': {
+                    'creationTime': f'{year}-{1 + number % 12:02d}-{1 + number % 28:02d}T12:00:{number % 60:02d}Z',
+                    **({'video': {'status': 'READY'}} if video else {}),
+                },
+            })
+        # Newest first, as mediaItems.list returns them.
+        self.items.reverse()
+        self.by_id = {item['id']: item for item in self.items}
+        self.deleted = set()
+        self.__blocks = {'image': bytes(range(256)) * (image_size // 256),
+                         'video': bytes(range(256)) * (video_size // 256)}
+
+    def content(self, item_id) -> bytes:
+        block = self.__blocks['video' if self.by_id[item_id]['mimeType'].startswith('video') else 'image']
+        # Unique head, so the files are not deduplicated.
+        return item_id.encode().ljust(32, b'-') + block[32:]
+
+    def preview(self, item_id, width, height) -> bytes:
+        """Reduced-size JPEG of the item, a frame of a video: 1/8 of the original, a byte per 16 pixels at most."""
+        content = self.content(item_id)
+        return content[:max(32, min(len(content) // 8, width * height // 16))]
+
+    def delete(self, share, seed=1):
+        """Deletes a share of the library, for actualization runs."""
+        rnd = random.Random(seed)
+        self.deleted.update(item['id'] for item in self.items if rnd.random() < share)
+
+    def exists(self, item_id) -> bool:
+        return item_id in self.by_id and item_id not in self.deleted
+
+
+class FakeGooglePhotos(ThreadingMixIn, HTTPServer):
+    """Local stub of the Google Photos Library API endpoints used by the app.
+
+    Serves mediaItems paging, mediaItems/{id}, mediaItems:batchGet, baseUrl '=d'/'=dv' downloads
+    and '=w{W}-h{H}' previews with Range support. Every response waits for latency seconds, error_rate share of requests
+    fails with 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, library, latency=0.0, error_rate=0.0, port=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.library = library
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def count(self, endpoint, size=0):
+        with self.__lock:
+            self.requests[endpoint] += 1
+            self.bytes_sent += size
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, name='fake-google-photos', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections at exit, it is not worth a traceback.
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeGooglePhotos
+
+    def log_message(self, *args):
+        pass
+
+    def __send(self, code, body=b'', content_type='application/json', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_json(self, representation):
+        self.__send(200, json.dumps(representation).encode())
+
+    def __representation(self, item):
+        return dict(item, baseUrl=f'{self.server.url}media/{item["id"]}')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if self.server.latency:
+            sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count('error')
+            return self.__send(503, b'{"error": "backend error"}')
+        if url.path == '/v1/mediaItems':
+            return self.__list(query)
+        if url.path == '/v1/mediaItems:batchGet':
+            return self.__batch_get(query)
+        if url.path.startswith('/v1/mediaItems/'):
+            self.server.count('get')
+            item_id = url.path.rsplit('/', 1)[1]
+            if not self.server.library.exists(item_id):
+                return self.__send(404, b'{"error": "not found"}')
+            return self.__send_json(self.__representation(self.server.library.by_id[item_id]))
+        if url.path.startswith('/media/'):
+            return self.__download(url.path[len('/media/'):])
+        self.__send(404)
+
+    def __list(self, query):
+        self.server.count('list')
+        library = self.server.library
+        page_size = min(int(query.get('pageSize', [MAX_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+        start = int(query.get('pageToken', ['0'])[0] or 0)
+        items = [item for item in library.items[start:start + page_size] if item['id'] not in library.deleted]
+        page = {'mediaItems': [self.__representation(item) for item in items]}
+        if start + page_size < len(library.items):
+            page['nextPageToken'] = str(start + page_size)
+        self.__send_json(page)
+
+    def __batch_get(self, query):
+        self.server.count('batchGet')
+        ids = query.get('mediaItemIds', [])
+        if len(ids) > BATCH_GET_LIMIT:
+            return self.__send(400, b'{"error": "too many ids"}')
+        library = self.server.library
+        self.__send_json({'mediaItemResults': [
+            {'mediaItem': self.__representation(library.by_id[item_id])} if library.exists(item_id)
+            else {'status': {'code': 5, 'message': 'NOT_FOUND'}} for item_id in ids]})
+
+    def __download(self, path):
+        item_id, _, suffix = path.partition('=')
+        preview = PREVIEW_SUFFIX.fullmatch(suffix)
+        if not self.server.library.exists(item_id) or not (preview or suffix in ('d', 'dv')):
+            return self.__send(404, b'<html>not found</html>', 'text/html')
+        if preview:
+            content = self.server.library.preview(item_id, int(preview.group(1)), int(preview.group(2)))
+            content_type = 'image/jpeg'
+        else:
+            content = self.server.library.content(item_id)
+            content_type = self.server.library.by_id[item_id]['mimeType']
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start = int(byte_range.split('=', 1)[1].split('-', 1)[0])
+            if start >= len(content):
+                return self.__send(416, headers={'Content-Range': f'bytes */{len(content)}'})
+            self.server.count('download', len(content) - start)
+            return self.__send(206, content[start:], content_type,
+                               {'Content-Range': f'bytes {start}-{len(content) - 1}/{len(content)}'})
+        self.server.count('download', len(content))
+        self.__send(200, content, content_type)
@@ -0,0 +1,202 @@
+"""Offline sync benchmark against a local fake Google Photos server.
+
+Usage: python3 -m bench.run --items 5000 --latency 0.02 --error-rate 0.01
+"""
+import os
+import sys
+import json
+import types
+import shutil
+import sqlite3
+import tempfile
+
+from argparse import ArgumentParser
+from time import monotonic
+from bench.fake_server import Library, FakeGooglePhotos
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        started = monotonic()
+        try:
+            return super().execute(*args)
+        finally:
+            self.connection.db_time += monotonic() - started
+
+    def executemany(self, *args):
+        started = monotonic()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.connection.db_time += monotonic() - started
+
+    def fetchall(self):
+        started = monotonic()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.db_time += monotonic() - started
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that sums up time spent in the DB calls."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db_time = 0.0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        started = monotonic()
+        try:
+            return super().commit()
+        finally:
+            self.db_time += monotonic() - started
+
+    def __exit__(self, *args):
+        started = monotonic()
+        try:
+            return super().__exit__(*args)
+        finally:
+            self.db_time += monotonic() - started
+
+
+def load_config(work_dir, overrides):
+    """Builds app.config.config from the example with paths in work_dir, the app imports it as usual."""
+    config = types.ModuleType('app.config.config')
+    with open(os.path.join(ROOT_DIR, 'app/config/config.py.example')) as example:
+        exec(example.read(), config.__dict__)
+    config.DB_FILE_PATH = os.path.join(work_dir, 'db.sqlite')
+    config.ACCESS_TOKEN_FILE_PATH = os.path.join(work_dir, 'token.json')
+    config.PATH_TO_IMAGES_STORAGE = os.path.join(work_dir, 'images') + '/'
+    config.PATH_TO_VIDEOS_STORAGE = os.path.join(work_dir, 'videos') + '/'
+    config.LOG_FILE_PATH = os.path.join(work_dir, 'bench.log')
+    config.ACTUALIZATION_NOT_OLD = 100 * 365
+    config.API_DAILY_QUOTA = 10 ** 9
+    config.API_REQUESTS_PER_SECOND = 10 ** 6
+    config.API_REQUESTS_BURST = 10 ** 6
+    config.HTTP_BACKOFF_FACTOR = 0.01
+    config.__dict__.update(overrides)
+    sys.modules['app.config.config'] = config
+    return config
+
+
+class BenchAuth:
+    """Authentication stand-in, the fake server accepts any token."""
+
+    def __init__(self, quota):
+        self.access_token = 'bench'
+        self.quota = quota
+
+    def refresh(self, stale_token=None):
+        pass
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='my-g-photo-bench-')
+    overrides = {'DOWNLOAD_WORKERS': args.workers, 'LISTING_PAGE_SIZE': args.page_size, 'PREVIEW_MODE': args.preview}
+    config = load_config(work_dir, overrides)
+    os.makedirs(config.PATH_TO_IMAGES_STORAGE)
+    os.makedirs(config.PATH_TO_VIDEOS_STORAGE)
+
+    from app.main import MetadataList, LocalStorage
+    from app.tools import helpers, media, quota
+
+    helpers.init_logging(config.LOG_FILE_PATH)
+
+    library = Library(args.items, args.video_share, args.image_kb * 2 ** 10, args.video_kb * 2 ** 10)
+    server = FakeGooglePhotos(library, args.latency, args.error_rate).start()
+    media.SRV_ENDPOINT = server.url + 'v1/'
+    shutil.copy(os.path.join(ROOT_DIR, 'db/db.sqlite.structure'), config.DB_FILE_PATH)
+    db_conn = helpers.db_connect(config.DB_FILE_PATH, factory=TimedConnection)
+    helpers.db_migrate(db_conn, os.path.join(ROOT_DIR, 'db/migrations'))
+    helpers.init_http_session(config.HTTP_POOL_SIZE, config.HTTP_RETRIES, config.HTTP_BACKOFF_FACTOR,
+                              config.HTTP_TIMEOUT)
+    quota.init_rate_limiter(config.API_REQUESTS_PER_SECOND, config.API_REQUESTS_BURST)
+    auth = BenchAuth(quota.ApiQuota(config.API_DAILY_QUOTA))
+
+    def listing():
+        return MetadataList(db_conn).get_metadata_list(auth)
+
+    def download():
+        return LocalStorage(db_conn).download_media_items(auth)
+
+    def actualization():
+        library.delete(args.delete_share)
+        count = db_conn.execute("SELECT count(*) FROM my_media WHERE stored != '0'").fetchone()[0]
+        LocalStorage(db_conn).remove_not_existing(auth)
+        return count
+
+    report = {'items': args.items, 'workers': args.workers, 'latency': args.latency, 'error_rate': args.error_rate,
+              'preview': args.preview, 'phases': {}}
+    try:
+        for name, phase in (('listing', listing), ('download', download), ('actualization', actualization)):
+            requests_before, bytes_before, db_time_before = server.requests.copy(), server.bytes_sent, db_conn.db_time
+            started = monotonic()
+            items = phase()
+            elapsed = monotonic() - started
+            size = server.bytes_sent - bytes_before
+            report['phases'][name] = {
+                'items': items,
+                'seconds': round(elapsed, 3),
+                'items_per_second': round(items / elapsed, 1) if elapsed else None,
+                'mb_per_second': round(size / 2 ** 20 / elapsed, 2) if elapsed else None,
+                'db_seconds': round(db_conn.db_time - db_time_before, 3),
+                'requests': dict(server.requests - requests_before),
+            }
+    finally:
+        server.stop()
+        db_conn.close()
+        if not args.keep:
+            shutil.rmtree(work_dir)
+    return report
+
+
+def print_report(report):
+    print(f"{report['items']} items, {report['workers']} workers, latency {report['latency']} s, "
+          f"error rate {report['error_rate']}{', preview mode' if report.get('preview') else ''}")
+    print(f"{'phase':<14}{'items':>8}{'s':>9}{'items/s':>10}{'MB/s':>9}{'DB s':>8}  requests")
+    for name, phase in report['phases'].items():
+        requests = ', '.join(f'{key}: {value}' for key, value in sorted(phase['requests'].items()))
+        print(f"{name:<14}{phase['items']:>8}{phase['seconds']:>9.2f}{phase['items_per_second'] or 0:>10.1f}"
+              f"{phase['mb_per_second'] or 0:>9.2f}{phase['db_seconds']:>8.2f}  {requests}")
+
+
+def main():
+    parser = ArgumentParser(description='Runs listing, download and actualization against a fake server.')
+    parser.add_argument('--items', type=int, default=2000, help='library size')
+    parser.add_argument('--video-share', type=float, default=0.1)
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--video-kb', type=int, default=4096)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failed with 503')
+    parser.add_argument('--delete-share', type=float, default=0.05, help='share of items deleted before actualization')
+    parser.add_argument('--workers', type=int, default=4, help='DOWNLOAD_WORKERS')
+    parser.add_argument('--page-size', type=int, default=100, help='LISTING_PAGE_SIZE')
+    parser.add_argument('--preview', action='store_true', help='PREVIEW_MODE, previews of all items before originals')
+    parser.add_argument('--json', help='also write the report to this file, e.g. to compare runs')
+    parser.add_argument('--metrics', help='write the app metrics in Prometheus text format to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the work dir with the DB, media and log')
+    args = parser.parse_args()
+    report = run(args)
+    print_report(report)
+    if args.metrics:
+        from app.tools import metrics
+        metrics.write_file(args.metrics)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
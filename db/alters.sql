@@ -1,4 +0,0 @@
-CREATE TABLE "account_info" (
-	"key"	TEXT UNIQUE,
-	"value"	TEXT
-);
\ No newline at end of file
@@ -0,0 +1,4 @@
+CREATE TABLE IF NOT EXISTS "account_info" (
+	"key"	TEXT UNIQUE,
+	"value"	TEXT
+);
@@ -0,0 +1,4 @@
+-- Download selection: WHERE stored = '0' ORDER BY creation_time
+CREATE INDEX IF NOT EXISTS "my_media_stored_creation_time" ON "my_media" ("stored", "creation_time");
+-- Actualization selection: WHERE creation_time > ?
+CREATE INDEX IF NOT EXISTS "my_media_creation_time" ON "my_media" ("creation_time");
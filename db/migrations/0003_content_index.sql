@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS "content_index" (
+	"path"	TEXT PRIMARY KEY,
+	"hash"	TEXT,
+	"size"	INTEGER
+);
+CREATE INDEX IF NOT EXISTS "content_index_hash_size" ON "content_index" ("hash", "size");
+-- Path of the stored file, it differs from year/filename after a name collision or for a duplicate.
+ALTER TABLE "my_media" ADD COLUMN "local_path" TEXT;
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS "download_queue" (
+	"object_id"	TEXT PRIMARY KEY,
+	-- 0 - small files, 1 - videos and files larger than LARGE_FILE_SIZE, downloaded in their own slots
+	"priority"	INTEGER DEFAULT 0,
+	"attempts"	INTEGER DEFAULT 0,
+	-- UTC '%Y-%m-%dT%H:%M:%SZ', NULL if the item has not failed yet
+	"next_retry_at"	TEXT,
+	-- Bytes, known after the first attempt
+	"size"	INTEGER
+);
@@ -0,0 +1,6 @@
+-- 'image' or 'video', NULL for an unexpected mime type, the item is not downloaded then.
+ALTER TABLE "my_media" ADD COLUMN "media_class" TEXT;
+-- Path of the file in the local storage, it is set when the item is listed, see app.tools.storage.PathResolver.
+ALTER TABLE "my_media" ADD COLUMN "target_path" TEXT;
+UPDATE "my_media" SET "media_class" = CASE WHEN "media_type" LIKE '%image%' THEN 'image'
+	WHEN "media_type" LIKE '%video%' THEN 'video' END;
@@ -0,0 +1,3 @@
+-- Path of the reduced-size preview, it is set in preview mode until the original is stored.
+-- The stored level of an item: the original if stored != '0', the preview if preview_path is set, nothing otherwise.
+ALTER TABLE "my_media" ADD COLUMN "preview_path" TEXT;
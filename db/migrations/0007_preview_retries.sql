@@ -0,0 +1,4 @@
+-- Retry state of the preview, kept apart from the one of the original, so a failing preview does not hold it back.
+ALTER TABLE "download_queue" ADD COLUMN "preview_attempts" INTEGER DEFAULT 0;
+-- UTC '%Y-%m-%dT%H:%M:%SZ', NULL if the preview has not failed yet
+ALTER TABLE "download_queue" ADD COLUMN "preview_next_retry_at" TEXT;
@@ -0,0 +1,7 @@
+-- The actualization checkpoint was the object_id of the last checked item, it is the id of the item now.
+-- The id is taken from the item, the checkpoint of an item deleted since then is dropped.
+INSERT OR REPLACE INTO "account_info" ("key", "value")
+	SELECT 'last_processed_id', "my_media"."id" FROM "account_info"
+	JOIN "my_media" ON "my_media"."object_id" = "account_info"."value"
+	WHERE "account_info"."key" = 'last_processed_object_id';
+DELETE FROM "account_info" WHERE "key" = 'last_processed_object_id';
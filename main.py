@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
+from argparse import ArgumentParser
 from os import path, chdir
 from app.main import Main
-from time import sleep
 
 ROOT_DIR = path.dirname(path.abspath(__file__))
 chdir(ROOT_DIR)
 
 
 if __name__ == '__main__':
-    while True:
-        Main().main()
-        sleep(300)
+    parser = ArgumentParser(description='Downloads media files and metadata from your Google Photo storage.')
+    parser.add_argument('command', nargs='?', default='daemon', choices=('daemon', 'index', 'reconcile'),
+                        help="'daemon' syncs until interrupted (default), "
+                             "'index' adds existing local files to the content index, "
+                             "'reconcile' resets items missing in local storage and lists orphaned files")
+    args = parser.parse_args()
+    if args.command == 'index':
+        Main().index()
+    elif args.command == 'reconcile':
+        Main().reconcile()
+    else:
+        Main().run_daemon()
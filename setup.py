@@ -14,5 +14,6 @@ setup(
         'google_auth_oauthlib',
         'google-auth',
         'requests',
+        'urllib3',
     ],
 )
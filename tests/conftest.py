@@ -0,0 +1,90 @@
+"""Fixtures of the tests, the app runs against bench.fake_server with the config built from the example."""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from bench.fake_server import Library, FakeGooglePhotos
+from bench.run import ROOT_DIR, BenchAuth, load_config
+
+# The app imports its config at import time, paths of it are set per test by the sync fixture.
+config = load_config(tempfile.gettempdir(), {})
+
+from app import main  # noqa: E402
+from app.tools import admission, helpers, media, quota  # noqa: E402
+
+
+class Sync:
+    """A migrated DB of the default account and a storage in work_dir, synced with the library of a fake server."""
+
+    def __init__(self, work_dir, library):
+        self.library = library
+        self.server = FakeGooglePhotos(library).start()
+        self.images_root = os.path.join(work_dir, 'images') + '/'
+        self.videos_root = os.path.join(work_dir, 'videos') + '/'
+        shutil.copy(os.path.join(ROOT_DIR, 'db/db.sqlite.structure'), os.path.join(work_dir, 'db.sqlite'))
+        self.db_conn = helpers.db_connect(os.path.join(work_dir, 'db.sqlite'))
+        helpers.db_migrate(self.db_conn, os.path.join(ROOT_DIR, 'db/migrations'))
+        self.auth = BenchAuth(quota.ApiQuota(config.API_DAILY_QUOTA))
+
+    def listing(self) -> int:
+        return main.MetadataList(self.db_conn).get_metadata_list(self.auth)
+
+    def download(self, limit=None) -> int:
+        return main.LocalStorage(self.db_conn).download_media_items(self.auth, limit)
+
+    def actualization(self) -> bool:
+        return main.LocalStorage(self.db_conn).remove_not_existing(self.auth)
+
+    def reconcile(self) -> list:
+        return main.LocalStorage(self.db_conn).reconcile()
+
+    def index(self) -> int:
+        return main.LocalStorage(self.db_conn).index_local_storage()
+
+    def items(self) -> dict:
+        """Returns (stored, local_path, target_path, preview_path) of the items by object_id."""
+        rows = self.db_conn.execute("SELECT object_id, stored, local_path, target_path, preview_path FROM my_media")
+        return {row[0]: row[1:] for row in rows}
+
+    def queue(self) -> dict:
+        """Returns (attempts, next_retry_at, preview_attempts, preview_next_retry_at) of the queue by object_id."""
+        rows = self.db_conn.execute("SELECT object_id, attempts, next_retry_at, preview_attempts, "
+                                    "preview_next_retry_at FROM download_queue")
+        return {row[0]: row[1:] for row in rows}
+
+    def close(self):
+        self.db_conn.close()
+        self.server.stop()
+
+
+@pytest.fixture
+def make_sync(tmp_path, monkeypatch):
+    """Returns a factory of Sync, its arguments are the ones of the fake library."""
+    syncs = []
+
+    def make(size=10, **library_options):
+        sync = Sync(str(tmp_path), Library(size, **library_options))
+        syncs.append(sync)
+        monkeypatch.setattr(media, 'SRV_ENDPOINT', sync.server.url + 'v1/')
+        for key, value in (('DB_FILE_PATH', os.path.join(tmp_path, 'db.sqlite')),
+                           ('PATH_TO_IMAGES_STORAGE', sync.images_root),
+                           ('PATH_TO_VIDEOS_STORAGE', sync.videos_root),
+                           ('LOG_FILE_PATH', os.path.join(tmp_path, 'test.log'))):
+            monkeypatch.setattr(config, key, value)
+        return sync
+
+    monkeypatch.setattr(quota, 'rate_limiter', quota.RateLimiter(config.API_REQUESTS_PER_SECOND,
+                                                                 config.API_REQUESTS_BURST))
+    monkeypatch.setattr(admission, 'bandwidth_limiter', admission.BandwidthLimiter())
+    monkeypatch.setattr(admission, 'controller', admission.AdmissionController())
+    helpers.init_http_session(4, 0, 0.0, 10)
+    yield make
+    for sync in syncs:
+        sync.close()
+
+
+@pytest.fixture
+def sync(make_sync) -> Sync:
+    return make_sync()
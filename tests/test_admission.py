@@ -0,0 +1,50 @@
+import builtins
+import errno
+import os
+from types import SimpleNamespace
+
+from app.config import config
+from app.tools import admission, media
+
+
+def test_low_disk_space_pauses_downloads(make_sync, monkeypatch):
+    sync = make_sync(4)
+    sync.listing()
+    with monkeypatch.context() as full_disk:
+        full_disk.setattr(admission.os, 'statvfs', lambda folder: SimpleNamespace(f_bavail=0, f_frsize=4096))
+        assert sync.download() == 0
+    assert sync.server.requests['download'] == 0
+    assert all(item[0] == 0 for item in sync.items().values())
+    assert all(row[:2] == (0, None) for row in sync.queue().values())
+
+    assert sync.download() == 4
+    assert all(item[0] == 1 for item in sync.items().values())
+
+
+def test_disk_full_while_writing_pauses_downloads(make_sync, monkeypatch):
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', 1)
+    sync = make_sync(4)
+    sync.listing()
+
+    class FullDisk:
+        def __init__(self, media_file):
+            self.__media_file = media_file
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.__media_file.close()
+
+        def write(self, chunk):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(media, 'open', lambda *args: FullDisk(builtins.open(*args)), raising=False)
+    assert sync.download() == 1
+    assert all(item[0] == 0 for item in sync.items().values())
+    assert all(row[:2] == (0, None) for row in sync.queue().values())
+
+    monkeypatch.delattr(media, 'open')
+    assert sync.download() == 4
+    assert all(item[0] == 1 for item in sync.items().values())
+    assert not sync.queue()
@@ -0,0 +1,67 @@
+import os
+
+from app.config import config
+
+
+def make_duplicates(make_sync, monkeypatch, hard_links):
+    """Syncs a library of two items with the same content, returns the sync and (original, duplicate) ids."""
+    sync = make_sync(2)
+    content = sync.library.content('FAKE000000000')
+    monkeypatch.setattr(sync.library, 'content', lambda item_id: content)
+    monkeypatch.setattr(config, 'DEDUP_HARD_LINKS', hard_links)
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', 1)
+    sync.listing()
+    sync.download()
+    items = sync.items()
+    original = next(object_id for object_id, item in items.items() if item[2] == item[1])
+    duplicate = next(object_id for object_id in items if object_id != original)
+    return sync, original, duplicate
+
+
+def indexed_paths(sync) -> set:
+    return {path for (path,) in sync.db_conn.execute("SELECT path FROM content_index")}
+
+
+def test_duplicate_is_hard_linked(make_sync, monkeypatch):
+    sync, original, duplicate = make_duplicates(make_sync, monkeypatch, hard_links=True)
+    items = sync.items()
+    assert items[original][0] == 1 and items[duplicate][0] == 1
+    assert items[duplicate][1] == items[duplicate][2]
+    assert os.path.samefile(items[original][1], items[duplicate][1])
+    assert indexed_paths(sync) == {items[original][1], items[duplicate][1]}
+    assert sync.server.requests['download'] == 2
+
+
+def test_duplicate_refers_to_the_file_without_hard_links(make_sync, monkeypatch):
+    sync, original, duplicate = make_duplicates(make_sync, monkeypatch, hard_links=False)
+    items = sync.items()
+    assert items[original][0] == 1
+    assert items[duplicate][0] == 2
+    assert items[duplicate][1] == items[original][1]
+    assert not os.path.exists(items[duplicate][2])
+    assert indexed_paths(sync) == {items[original][1]}
+
+
+def test_removed_duplicate_keeps_the_shared_file(make_sync, monkeypatch):
+    sync, original, duplicate = make_duplicates(make_sync, monkeypatch, hard_links=False)
+    path = sync.items()[original][1]
+    # The original was stored before local_path was added, its file is at target_path.
+    with sync.db_conn:
+        sync.db_conn.execute("UPDATE my_media SET local_path = NULL WHERE object_id = ?", (original,))
+    sync.library.deleted.add(duplicate)
+    assert sync.actualization()
+    items = sync.items()
+    assert duplicate not in items
+    assert items[original] == (1, None, path, None)
+    assert os.path.exists(path)
+    assert indexed_paths(sync) == {path}
+
+
+def test_removed_last_reference_removes_the_file(make_sync, monkeypatch):
+    sync, original, duplicate = make_duplicates(make_sync, monkeypatch, hard_links=False)
+    path = sync.items()[original][1]
+    sync.library.deleted.update((original, duplicate))
+    assert sync.actualization()
+    assert sync.items() == {}
+    assert not os.path.exists(path)
+    assert indexed_paths(sync) == set()
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from app.config import config
+
+
+def retry_delay(next_retry_at) -> float:
+    return (datetime.strptime(next_retry_at, "%Y-%m-%dT%H:%M:%SZ") - datetime.utcnow()).total_seconds()
+
+
+def test_unexpected_content_type_is_postponed_with_backoff(make_sync):
+    sync = make_sync(5)
+    sync.listing()
+    broken = sync.library.items[0]['id']
+    # Served as neither an image nor a video from now on.
+    sync.library.by_id[broken]['mimeType'] = 'application/octet-stream'
+
+    assert sync.download() == 5
+    items = sync.items()
+    assert items[broken][0] == 0
+    assert all(item[0] == 1 for object_id, item in items.items() if object_id != broken)
+    attempts, next_retry_at = sync.queue()[broken][:2]
+    assert attempts == 1
+    assert abs(retry_delay(next_retry_at) - config.DOWNLOAD_RETRY_BASE_DELAY) < 60
+
+    # The item is not retried before its time.
+    downloads = sync.server.requests['download']
+    assert sync.download() == 0
+    assert sync.server.requests['download'] == downloads
+
+    with sync.db_conn:
+        sync.db_conn.execute("UPDATE download_queue SET next_retry_at = '2000-01-01T00:00:00Z'")
+    assert sync.download() == 1
+    attempts, next_retry_at = sync.queue()[broken][:2]
+    assert attempts == 2
+    assert abs(retry_delay(next_retry_at) - 2 * config.DOWNLOAD_RETRY_BASE_DELAY) < 60
@@ -0,0 +1,63 @@
+import os
+import re
+
+import pytest
+
+from app.config import config
+from bench import fake_server
+
+IMAGE_SIZE = 64 * 2 ** 10
+
+
+@pytest.fixture
+def preview_sync(make_sync, monkeypatch):
+    monkeypatch.setattr(config, 'PREVIEW_MODE', True)
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', 1)
+    sync = make_sync(4, video_share=0, image_size=IMAGE_SIZE)
+    sync.listing()
+    return sync
+
+
+def test_previews_are_replaced_by_originals(preview_sync, monkeypatch):
+    monkeypatch.setattr(config, 'DOWNLOAD_BYTES_PER_DAY', 0)
+    assert preview_sync.download() == 4
+    items = preview_sync.items()
+    assert all(item[0] == 0 and item[3] and os.path.exists(item[3]) for item in items.values())
+    assert all(os.sep + '.previews' + os.sep in item[3] for item in items.values())
+
+    monkeypatch.setattr(config, 'DOWNLOAD_BYTES_PER_DAY', None)
+    assert preview_sync.download() == 4
+    stored = preview_sync.items()
+    assert all(item[0] == 1 and item[3] is None and os.path.exists(item[1]) for item in stored.values())
+    assert not any(os.path.exists(item[3]) for item in items.values())
+
+
+def test_failed_preview_does_not_hold_back_the_original(preview_sync, monkeypatch):
+    # The server does not serve previews, each of them fails.
+    monkeypatch.setattr(fake_server, 'PREVIEW_SUFFIX', re.compile('(?!)'))
+    monkeypatch.setattr(config, 'DOWNLOAD_BYTES_PER_DAY', 0)
+    preview_sync.download()
+    queue = preview_sync.queue()
+    assert all(row[2] == 1 and row[3] for row in queue.values())
+    assert all(row[0] == 0 and row[1] is None for row in queue.values())
+
+    monkeypatch.setattr(config, 'DOWNLOAD_BYTES_PER_DAY', None)
+    assert preview_sync.download() == 4
+    assert all(item[0] == 1 for item in preview_sync.items().values())
+    assert preview_sync.server.requests['download'] == 4
+
+
+def test_byte_budget_holds_across_runs(preview_sync, monkeypatch):
+    monkeypatch.setattr(config, 'PREVIEW_MODE', False)
+    monkeypatch.setattr(config, 'DOWNLOAD_BYTES_PER_DAY', 2 * IMAGE_SIZE)
+    assert preview_sync.download() == 2
+    assert sum(item[0] for item in preview_sync.items().values()) == 2
+    # The next run of the day, e.g. of the daemon, downloads nothing.
+    downloads = preview_sync.server.requests['download']
+    assert preview_sync.download() == 0
+    assert preview_sync.server.requests['download'] == downloads
+
+    with preview_sync.db_conn:
+        preview_sync.db_conn.execute("UPDATE account_info SET value = '2000-01-01' WHERE key = 'download_bytes_day'")
+    assert preview_sync.download() == 2
+    assert all(item[0] == 1 for item in preview_sync.items().values())
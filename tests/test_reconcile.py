@@ -0,0 +1,38 @@
+import os
+
+
+def write(path, content=b'stray'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(content)
+
+
+def test_reconcile_resets_missing_files_and_reports_orphans(make_sync):
+    sync = make_sync(4)
+    sync.listing()
+    sync.download()
+    items = sync.items()
+    missing, kept = sorted(items)[:2]
+    os.remove(items[missing][1])
+    orphan = os.path.join(sync.images_root, '2015', 'stray.jpg')
+    write(orphan)
+    # Parts of interrupted downloads and previews are hidden, they are not a part of the storage.
+    part = os.path.join(os.path.dirname(items[kept][1]), '.FAKE999999999.part')
+    write(part)
+    preview = os.path.join(sync.images_root, '.previews', '2015', 'preview.jpg')
+    write(preview)
+
+    assert sync.reconcile() == [orphan]
+
+    items_after = sync.items()
+    assert items_after[missing] == (0, None, items[missing][2], None)
+    assert all(items_after[object_id] == items[object_id] for object_id in items if object_id != missing)
+    indexed = {path for (path,) in sync.db_conn.execute("SELECT path FROM content_index")}
+    assert indexed == {item[1] for object_id, item in items.items() if object_id != missing}
+    assert os.path.exists(orphan) and os.path.exists(part) and os.path.exists(preview)
+
+    # The reset item is downloaded again by the next run.
+    assert sync.download() == 1
+    assert sync.items()[missing] == items[missing]
+    assert os.path.exists(items[missing][1])
+    assert sync.reconcile() == [orphan]